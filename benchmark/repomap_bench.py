@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+Benchmark the repo map on a synthetic multi-language repository.
+
+Generates a repo of configurable size, then separately times:
+
+- cold_scan: extracting the tags of every file into an empty tags cache
+- warm_scan: loading every file's tags back from the warm cache
+- ranked_tags: building the symbol graph and ranking it, from the warm cache
+- ranked_tags_again: ranking again with nothing changed
+- map_search: the token budget search of get_ranked_tags_map_uncached
+
+Results are written as JSON, so runs can be compared:
+
+    python benchmark/repomap_bench.py --files 2000 --output before.json
+"""
+
+import argparse
+import functools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from papertlab import __version__  # noqa: E402
+from papertlab.dump import dump  # noqa: E402, F401
+from papertlab.repomap import RepoMap  # noqa: E402
+
+LANGUAGES = ["python", "javascript", "go", "java"]
+
+EXTENSIONS = dict(python=".py", javascript=".js", go=".go", java=".java")
+
+
+class BenchIO:
+    encoding = "utf-8"
+
+    def read_text(self, fname):
+        try:
+            return Path(fname).read_text(encoding=self.encoding)
+        except (OSError, UnicodeError):
+            return
+
+    def tool_output(self, *messages, **kwargs):
+        pass
+
+    def tool_error(self, message="", **kwargs):
+        print(message, file=sys.stderr)
+
+
+class ApproxTokenCounter:
+    """Stands in for a Model, so the benchmark needs no tokenizer downloads or API keys."""
+
+    def token_count(self, text):
+        return len(text) // 4
+
+
+def symbol_name(lang, file_idx, sym_idx):
+    name = f"compute_{file_idx}_{sym_idx}"
+    if lang == "go":
+        return name.capitalize()
+    return name
+
+
+def render_file(lang, file_idx, symbols, refs):
+    """Source for one file defining symbols, each calling its list of (lang, name, file_idx)."""
+    lines = []
+
+    if lang == "python":
+        lines.append(f"class Module{file_idx}:")
+        lines.append("    scale = 2")
+        lines.append("")
+        for name, calls in zip(symbols, refs):
+            lines.append("")
+            lines.append(f"def {name}(value):")
+            terms = [f"{call}(value)" for _lang, call, _idx in calls] or ["value"]
+            lines.append(f"    return {' + '.join(terms)}")
+    elif lang == "javascript":
+        for name, calls in zip(symbols, refs):
+            terms = [f"{call}(value)" for _lang, call, _idx in calls] or ["value"]
+            lines.append(f"function {name}(value) {{")
+            lines.append(f"  return {' + '.join(terms)};")
+            lines.append("}")
+            lines.append("")
+    elif lang == "go":
+        lines.append(f"package module{file_idx}")
+        lines.append("")
+        for name, calls in zip(symbols, refs):
+            terms = [f"{call}(value)" for _lang, call, _idx in calls] or ["value"]
+            lines.append(f"func {name}(value int) int {{")
+            lines.append(f"\treturn {' + '.join(terms)}")
+            lines.append("}")
+            lines.append("")
+    elif lang == "java":
+        lines.append(f"public class Module{file_idx} {{")
+        for name, calls in zip(symbols, refs):
+            terms = [
+                f"Module{idx}.{call}(value)" if call_lang == "java" else f"{call}(value)"
+                for call_lang, call, idx in calls
+            ] or ["value"]
+            lines.append(f"    public static int {name}(int value) {{")
+            lines.append(f"        return {' + '.join(terms)};")
+            lines.append("    }")
+            lines.append("")
+        lines.append("}")
+    else:
+        raise ValueError(f"Unsupported language: {lang}")
+
+    return "\n".join(lines) + "\n"
+
+
+def generate_repo(root, num_files, symbols_per_file, refs_per_symbol, languages, seed=0):
+    """Write a synthetic repo under root, returning the list of its file names.
+
+    Files are spread round-robin over the languages and grouped into directories of
+    50. Each symbol calls refs_per_symbol others, picked with a Zipf-like skew so a few
+    files are referenced heavily, as in real repos.
+    """
+    rnd = random.Random(seed)
+
+    files = []
+    for file_idx in range(num_files):
+        lang = languages[file_idx % len(languages)]
+        symbols = [symbol_name(lang, file_idx, i) for i in range(symbols_per_file)]
+        fname = Path(root) / f"pkg{file_idx // 50}" / f"module{file_idx}{EXTENSIONS[lang]}"
+        files.append((fname, lang, symbols))
+
+    weights = [1 / (i + 1) for i in range(num_files)]
+
+    fnames = []
+    for file_idx, (fname, lang, symbols) in enumerate(files):
+        refs = []
+        for _ in symbols:
+            targets = rnd.choices(range(num_files), weights=weights, k=refs_per_symbol)
+            calls = []
+            for target_idx in targets:
+                _target_fname, target_lang, target_symbols = files[target_idx]
+                calls.append((target_lang, rnd.choice(target_symbols), target_idx))
+            refs.append(calls)
+
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        fname.write_text(render_file(lang, file_idx, symbols, refs))
+        fnames.append(str(fname))
+
+    return fnames
+
+
+def measure(results, name, func, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    res = func()
+    elapsed = time.perf_counter() - start
+
+    phase = dict(seconds=round(elapsed, 4))
+    if trace_memory:
+        _current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        phase["peak_mb"] = round(peak / 1024 / 1024, 2)
+
+    results[name] = phase
+    print(f"{name:20} {elapsed:8.3f}s", file=sys.stderr)
+    return res
+
+
+def run(args):
+    languages = args.languages.split(",")
+    for lang in languages:
+        if lang not in EXTENSIONS:
+            raise ValueError(f"Unsupported language: {lang}, choose from {', '.join(LANGUAGES)}")
+
+    workdir = tempfile.mkdtemp(prefix="repomap-bench-")
+    try:
+        root = os.path.join(workdir, "repo")
+        cache_dir = os.path.join(workdir, "tags")
+
+        start = time.perf_counter()
+        fnames = generate_repo(root, args.files, args.symbols, args.refs, languages, seed=args.seed)
+        generate_time = time.perf_counter() - start
+
+        rnd = random.Random(args.seed)
+        chat_fnames = sorted(rnd.sample(fnames, min(args.chat_files, len(fnames))))
+        other_fnames = [fname for fname in fnames if fname not in set(chat_fnames)]
+        mentioned_idents = set()
+
+        main_model = ApproxTokenCounter()
+        if args.model:
+            from papertlab.models import Model
+
+            main_model = Model(args.model)
+
+        def new_repo_map():
+            return RepoMap(
+                map_tokens=args.map_tokens,
+                root=root,
+                main_model=main_model,
+                io=BenchIO(),
+                map_workers=args.map_workers,
+                rank_backend=args.rank_backend,
+                tags_cache_dir=cache_dir,
+            )
+
+        def scan(repo_map):
+            files = [
+                (fname, repo_map.get_rel_fname(fname), os.path.getmtime(fname))
+                for fname in fnames
+            ]
+            return repo_map.get_tags_many(files)
+
+        phases = dict()
+
+        cold = new_repo_map()
+        tags = measure(phases, "cold_scan", functools.partial(scan, cold), args.memory)
+        num_tags = sum(len(file_tags) for file_tags in tags.values())
+        del cold, tags
+
+        repo_map = new_repo_map()
+        measure(phases, "warm_scan", functools.partial(scan, repo_map), args.memory)
+
+        def rank():
+            return repo_map.get_ranked_tags(chat_fnames, other_fnames, set(), mentioned_idents)
+
+        ranked_tags = measure(phases, "ranked_tags", rank, args.memory)
+        measure(phases, "ranked_tags_again", rank, args.memory)
+
+        def map_search():
+            return repo_map.get_ranked_tags_map_uncached(
+                chat_fnames, other_fnames, args.map_tokens
+            )
+
+        repo_map_text = measure(phases, "map_search", map_search, args.memory)
+
+        return dict(
+            config=dict(
+                files=args.files,
+                symbols=args.symbols,
+                refs=args.refs,
+                languages=languages,
+                chat_files=len(chat_fnames),
+                map_tokens=args.map_tokens,
+                map_workers=args.map_workers,
+                rank_backend=args.rank_backend,
+                model=args.model,
+                seed=args.seed,
+                memory=args.memory,
+            ),
+            environment=dict(
+                papertlab=__version__,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                cpus=os.cpu_count(),
+            ),
+            repo=dict(
+                generate_seconds=round(generate_time, 4),
+                bytes=sum(os.path.getsize(fname) for fname in fnames),
+                tags=num_tags,
+            ),
+            phases=phases,
+            output=dict(
+                ranked_tags=len(ranked_tags),
+                map_tokens=main_model.token_count(repo_map_text or ""),
+            ),
+        )
+    finally:
+        if args.keep:
+            print(f"Kept benchmark repo in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repo map on a synthetic repo")
+    parser.add_argument("--files", type=int, default=1000, help="Number of files (default: 1000)")
+    parser.add_argument(
+        "--symbols", type=int, default=10, help="Symbols defined per file (default: 10)"
+    )
+    parser.add_argument(
+        "--refs", type=int, default=3, help="References made by each symbol (default: 3)"
+    )
+    parser.add_argument(
+        "--languages",
+        default=",".join(LANGUAGES),
+        help=f"Comma separated languages to generate (default: {','.join(LANGUAGES)})",
+    )
+    parser.add_argument(
+        "--chat-files", type=int, default=3, help="Files treated as in the chat (default: 3)"
+    )
+    parser.add_argument(
+        "--map-tokens", type=int, default=1024, help="Repo map token budget (default: 1024)"
+    )
+    parser.add_argument(
+        "--map-workers",
+        type=int,
+        default=None,
+        help="Tag extraction processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--rank-backend",
+        choices=["sparse", "networkx"],
+        default="sparse",
+        help="PageRank implementation (default: sparse)",
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="Count tokens with this model's tokenizer (default: approximate, 4 chars/token)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument(
+        "--memory",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Record each phase's peak memory with tracemalloc, which slows it (default: True)",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file (default: stdout)")
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the generated repo and tags cache"
+    )
+    args = parser.parse_args()
+
+    results = run(args)
+    results["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    text = json.dumps(results, indent=4)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
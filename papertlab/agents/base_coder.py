@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-import base64
 import hashlib
 import json
 import locale
@@ -12,7 +11,6 @@ import sys
 import threading
 import time
 import traceback
-from collections import defaultdict
 from datetime import datetime
 from json.decoder import JSONDecodeError
 from pathlib import Path
@@ -22,14 +20,18 @@ from rich.console import Console, Text
 from rich.markdown import Markdown
 
 from papertlab import __version__, models, prompts, urls, utils
+from papertlab.chunkbuffer import ChunkBuffer
 from papertlab.commands import Commands
+from papertlab.hedge import HEDGE_LEDGER
 from papertlab.history import ChatSummary
 from papertlab.io import ConfirmGroup, InputOutput
 from papertlab.linter import Linter
 from papertlab.llm import litellm
 from papertlab.mdstream import MarkdownStream
+from papertlab.ratelimit import RATE_LIMITER
 from papertlab.repo import GitRepo
 from papertlab.repomap import RepoMap
+from papertlab.retry import RETRY_STATS, Retrier
 from papertlab.run_cmd import run_cmd
 from papertlab.sendchat import retry_exceptions, send_completion
 from papertlab.utils import format_content, format_messages, format_tokens, is_image_file
@@ -37,6 +39,9 @@ from papertlab.sql_utils import get_auto_commit_db_status, save_auto_commit_db
 
 from ..dump import dump  # noqa: F401
 from .chat_chunks import ChatChunks
+from .file_index import FileIndex
+from .prompt_cache import PromptCacheTracker
+from .turn_context import TurnContext
 
 DB_PATH = 'papertlab_gui.db'
 
@@ -48,6 +53,10 @@ class FinishReasonLength(Exception):
     pass
 
 
+class PrebuildAbandoned(Exception):
+    """The prompt can't be prebuilt without side effects, so is left to the main thread."""
+
+
 def wrap_fence(name):
     return f"<{name}>", f"</{name}>"
 
@@ -84,7 +93,7 @@ class Coder:
     lint_outcome = None
     test_outcome = None
     multi_response_content = ""
-    partial_response_content = ""
+    partial_response_buffer = None
     commit_before_message = []
     message_cost = 0.0
     message_tokens_sent = 0
@@ -94,6 +103,19 @@ class Coder:
     num_cache_warming_pings = 0
     suggest_shell_commands = True
     ignore_mentions = None
+    rate_limit_reserved = None
+    file_index = None
+
+    @property
+    def partial_response_content(self):
+        if self.partial_response_buffer is None:
+            return ""
+        return self.partial_response_buffer.getvalue()
+
+    @partial_response_content.setter
+    def partial_response_content(self, value):
+        # Streamed chunks are appended to the buffer, not concatenated onto a str
+        self.partial_response_buffer = ChunkBuffer(value or "")
 
     @classmethod
     def create(
@@ -114,7 +136,7 @@ class Coder:
             if from_coder:
                 main_model = from_coder.main_model
             else:
-                main_model = models.Model(models.DEFAULT_MODEL_NAME)
+                main_model = models.get_model(models.DEFAULT_MODEL_NAME)
 
         if edit_format == "code":
             edit_format = None
@@ -148,6 +170,7 @@ class Coder:
                 papertlab_commit_hashes=from_coder.papertlab_commit_hashes,
                 commands=from_coder.commands.clone(),
                 total_cost=from_coder.total_cost,
+                prompt_cache_tracker=from_coder.prompt_cache_tracker,
             )
 
             use_kwargs.update(update)  # override to complete the switch
@@ -259,9 +282,16 @@ class Coder:
         git_commit_id = "",
         total_cost=0.0,
         map_refresh="auto",
+        map_workers=None,
+        tags_cache_dir=None,
+        map_watch=False,
+        map_cache_entries=None,
+        map_cache_mb=None,
         cache_prompts=False,
+        prompt_cache_tracker=None,
         num_cache_warming_pings=0,
         suggest_shell_commands=True,
+        prebuild_prompt=False,
     ):
         self.commit_before_message = []
         self.papertlab_commit_hashes = set()
@@ -273,6 +303,14 @@ class Coder:
 
         self.num_cache_warming_pings = num_cache_warming_pings
 
+        self.prompt_cache_tracker = prompt_cache_tracker or PromptCacheTracker()
+
+        self.prebuild_prompt = prebuild_prompt
+        self.prebuild_thread = None
+        self.prebuild_cancel = threading.Event()
+        self.prebuilt = None
+        self.prebuild_error = None
+
         if not fnames:
             fnames = []
 
@@ -414,7 +452,13 @@ class Coder:
                 max_inp_tokens,
                 map_mul_no_files=map_mul_no_files,
                 refresh=map_refresh,
+                map_workers=map_workers,
+                tags_cache_dir=tags_cache_dir,
+                cache_max_entries=map_cache_entries,
+                cache_max_mb=map_cache_mb,
             )
+            if map_watch:
+                self.repo_map.start_watcher(self.get_all_abs_files())
 
         self.summarizer = summarizer or ChatSummary(
             [self.main_model.weak_model, self.main_model],
@@ -520,6 +564,8 @@ class Coder:
             content = self.io.read_text(fname)
 
             if content is None:
+                if self.is_prebuilding():
+                    raise PrebuildAbandoned(fname)
                 relative_fname = self.get_rel_fname(fname)
                 self.io.tool_error(f"Dropping {relative_fname} from the chat.")
                 self.abs_fnames.remove(fname)
@@ -545,6 +591,8 @@ class Coder:
         if good:
             self.fence = (fence_open, fence_close)
         else:
+            if self.is_prebuilding():
+                raise PrebuildAbandoned("fence")
             self.fence = self.fences[0]
             self.io.tool_error(
                 "Unable to find a fencing strategy! Falling back to:"
@@ -600,32 +648,32 @@ class Coder:
         words = set(re.split(r"\W+", text))
         return words
 
-    def get_ident_filename_matches(self, idents):
-        all_fnames = defaultdict(set)
-        for fname in self.get_all_relative_files():
-            base = Path(fname).with_suffix("").name.lower()
-            if len(base) >= 5:
-                all_fnames[base].add(fname)
+    def get_ident_filename_matches(self, idents, file_index=None):
+        if file_index is None:
+            file_index = self.get_file_index()
+        return file_index.find_stems(idents)
 
-        matches = set()
-        for ident in idents:
-            if len(ident) < 5:
-                continue
-            matches.update(all_fnames[ident.lower()])
+    def get_file_index(self, all_rel_fnames=None):
+        """The FileIndex of the repo's files, only rebuilt when they change."""
+        if all_rel_fnames is None:
+            all_rel_fnames = self.get_all_relative_files()
 
-        return matches
+        if self.file_index is None or not self.file_index.is_current(all_rel_fnames):
+            self.file_index = FileIndex(all_rel_fnames)
+        return self.file_index
 
-    def get_repo_map(self, force_refresh=False):
+    def get_repo_map(self, force_refresh=False, turn=None):
         if not self.repo_map:
             return
 
-        cur_msg_text = self.get_cur_message_text()
-        mentioned_fnames = self.get_file_mentions(cur_msg_text)
-        mentioned_idents = self.get_ident_mentions(cur_msg_text)
+        if turn is None:
+            turn = TurnContext(self)
 
-        mentioned_fnames.update(self.get_ident_filename_matches(mentioned_idents))
+        # Copied, RepoMap may hold on to them
+        mentioned_fnames = set(turn.mentioned_fnames())
+        mentioned_idents = set(turn.mentioned_idents())
 
-        all_abs_files = set(self.get_all_abs_files())
+        all_abs_files = set(turn.all_abs_files())
         repo_abs_read_only_fnames = set(self.abs_read_only_fnames) & all_abs_files
         chat_files = set(self.abs_fnames) | repo_abs_read_only_fnames
         other_files = all_abs_files - chat_files
@@ -656,9 +704,9 @@ class Coder:
 
         return repo_content
 
-    def get_repo_messages(self):
+    def get_repo_messages(self, turn=None):
         repo_messages = []
-        repo_content = self.get_repo_map()
+        repo_content = turn.repo_map() if turn else self.get_repo_map()
         if repo_content:
             repo_messages += [
                 dict(role="user", content=repo_content),
@@ -684,13 +732,16 @@ class Coder:
             ]
         return readonly_messages
 
-    def get_chat_files_messages(self):
+    def get_chat_files_messages(self, turn=None):
+        if turn is None:
+            turn = TurnContext(self)
+
         chat_files_messages = []
         if self.abs_fnames:
             files_content = self.gpt_prompts.files_content_prefix
             files_content += self.get_files_content()
             files_reply = "Ok, any changes I propose will be to those files."
-        elif self.get_repo_map() and self.gpt_prompts.files_no_full_files_with_repo_map:
+        elif turn.repo_map() and self.gpt_prompts.files_no_full_files_with_repo_map:
             files_content = self.gpt_prompts.files_no_full_files_with_repo_map
             files_reply = self.gpt_prompts.files_no_full_files_with_repo_map_reply
         else:
@@ -719,8 +770,8 @@ class Coder:
         image_messages = []
         for fname, content in self.get_abs_fnames_content():
             if is_image_file(fname):
-                with open(fname, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
+                # io.read_text() returns images base64 encoded
+                encoded_string = content
                 mime_type, _ = mimetypes.guess_type(fname)
                 if mime_type and mime_type.startswith("image/"):
                     image_url = f"data:{mime_type};base64,{encoded_string}"
@@ -772,10 +823,15 @@ class Coder:
         read_only_files = [self.get_rel_fname(fname) for fname in self.abs_read_only_fnames]
         all_files = sorted(set(inchat_files + read_only_files))
         edit_format = "" if self.edit_format == self.main_model.edit_format else self.edit_format
+        addable_files = self.get_addable_relative_files()
+
+        # Only once we're done with the repo, so the prebuild doesn't share it with us
+        self.start_prebuild()
+
         return self.io.get_input(
             self.root,
             all_files,
-            self.get_addable_relative_files(),
+            addable_files,
             self.commands,
             self.abs_read_only_fnames,
             edit_format=edit_format,
@@ -794,6 +850,7 @@ class Coder:
         return inp
 
     def run_one(self, user_message, preproc):
+        self.finish_prebuild()
         self.init_before_message()
 
         if preproc:
@@ -933,6 +990,26 @@ class Coder:
         return prompt
 
     def format_chat_chunks(self):
+        start = time.perf_counter()
+        turn = TurnContext(self)
+
+        self.summarize_end()
+
+        chunks = self.take_prebuilt_chunks(turn)
+        if chunks is None:
+            chunks = self.format_base_chunks(turn)
+        elif self.verbose:
+            self.io.tool_output("Using the prompt prebuilt while you typed.")
+
+        self.add_cur_chunks(chunks)
+
+        if self.verbose:
+            self.io.tool_output(turn.report(time.perf_counter() - start))
+
+        return chunks
+
+    def format_base_chunks(self, turn):
+        """The chunks which come before the current messages."""
         self.choose_fence()
         main_sys = self.fmt_system_prompt(self.gpt_prompts.main_system)
 
@@ -975,13 +1052,16 @@ class Coder:
         ]
         chunks.examples = example_messages
 
-        self.summarize_end()
         chunks.done = self.done_messages
 
-        chunks.repo = self.get_repo_messages()
+        chunks.repo = self.get_repo_messages(turn)
         chunks.readonly_files = self.get_readonly_files_messages()
-        chunks.chat_files = self.get_chat_files_messages()
+        chunks.chat_files = self.get_chat_files_messages(turn)
 
+        return chunks
+
+    def add_cur_chunks(self, chunks):
+        """Add the current messages to chunks, with the system reminder if there's room."""
         if self.gpt_prompts.system_reminder:
             reminder_message = [
                 dict(
@@ -1025,8 +1105,129 @@ class Coder:
                 )
                 chunks.cur[-1] = dict(role=final["role"], content=new_content)
 
+    def get_prompt_state(self):
+        """A fingerprint of everything format_base_chunks() depends on.
+
+        Returns None if it can't be trusted yet, because a file was modified too recently
+        for its mtime to show a further change.
+        """
+        stamps = []
+        for fname in sorted(self.abs_fnames) + sorted(self.abs_read_only_fnames):
+            _path, stamp = self.io.content_stamp(fname)
+            if stamp is None:
+                return
+            stamps.append((fname, stamp))
+
+        tracked = None
+        if self.repo:
+            try:
+                index = os.stat(os.path.join(self.repo.repo.git_dir, "index"))
+                tracked = (self.repo.get_head(), index.st_mtime_ns, index.st_size)
+            except OSError:
+                tracked = (self.repo.get_head(), None, None)
+
+        done = self.done_messages
+        return (
+            tuple(stamps),
+            len(self.abs_fnames),
+            tracked,
+            id(done),
+            len(done),
+            id(done[-1]) if done else None,
+            self.summarizer_thread is None,
+        )
+
+    def start_prebuild(self):
+        """Start building the chunks for the next message in the background."""
+        if not self.prebuild_prompt:
+            return
+        if self.prebuild_thread and self.prebuild_thread.is_alive():
+            return
+
+        self.prebuilt = None
+        self.prebuild_error = None
+        self.prebuild_cancel.clear()
+        self.prebuild_thread = threading.Thread(target=self.prebuild_worker, daemon=True)
+        self.prebuild_thread.start()
+
+    def prebuild_worker(self):
+        try:
+            state = self.get_prompt_state()
+            if state is None:
+                # Wait for just edited files to settle, unless the user is quicker
+                if self.prebuild_cancel.wait(self.io.racy_seconds):
+                    return
+                state = self.get_prompt_state()
+                if state is None:
+                    return
+
+            # A map which depends on the new message's mentions is built once it's sent
+            with_repo_map = bool(self.repo_map) and self.repo_map.uses_cached_map()
+            turn = TurnContext(self, with_repo_map=with_repo_map)
+
+            # Nothing may print over the input being typed, and the main thread's fence
+            # is only replaced if the prebuilt chunks are used
+            main_fence = self.fence
+            try:
+                with self.io.quietly():
+                    if with_repo_map:
+                        with self.repo_map.quietly():
+                            chunks = self.format_base_chunks(turn)
+                    else:
+                        chunks = self.format_base_chunks(turn)
+                fence = self.fence
+            finally:
+                self.fence = main_fence
+
+            if state == self.get_prompt_state():
+                self.prebuilt = (state, fence, chunks, with_repo_map)
+        except PrebuildAbandoned:
+            # A file to drop or a fence warning, left for the main thread to report
+            pass
+        except Exception as err:
+            # Reported once the input is done
+            self.prebuild_error = err
+
+    def is_prebuilding(self):
+        thread = self.prebuild_thread
+        return thread is not None and thread is threading.current_thread()
+
+    def finish_prebuild(self):
+        """Wait for any prebuild in progress, so nothing else runs alongside it."""
+        if not self.prebuild_thread:
+            return
+
+        self.prebuild_cancel.set()
+        self.prebuild_thread.join()
+        self.prebuild_thread = None
+
+    def take_prebuilt_chunks(self, turn):
+        """The prebuilt base chunks, if nothing they depend on has changed since."""
+        self.finish_prebuild()
+
+        if self.prebuild_error and self.verbose:
+            self.io.tool_error(f"Unable to prebuild the prompt: {self.prebuild_error}")
+        self.prebuild_error = None
+
+        prebuilt = self.prebuilt
+        self.prebuilt = None
+        if not prebuilt:
+            return
+
+        state, fence, chunks, with_repo_map = prebuilt
+        if state != self.get_prompt_state():
+            return
+
+        self.fence = fence
+
+        # Add the map the prebuild left out, as it depends on what the new message mentions
+        if self.repo_map and not (with_repo_map and self.repo_map.uses_cached_map()):
+            chunks.repo = self.get_repo_messages(turn)
+            if not self.abs_fnames:
+                chunks.chat_files = self.get_chat_files_messages(turn)
+
         return chunks
-    
+
     def format_messages(self):
         chunks = self.format_chat_chunks()
         if self.add_cache_headers:
@@ -1095,6 +1296,10 @@ class Coder:
         messages = chunks.all_messages()
         self.warm_cache(chunks)
 
+        prefix_change = self.prompt_cache_tracker.observe(chunks)
+        if prefix_change and (self.verbose or self.add_cache_headers):
+            self.io.tool_output(prefix_change)
+
         if self.verbose:
             utils.show_messages(messages, functions=self.functions)
 
@@ -1105,7 +1310,7 @@ class Coder:
         else:
             self.mdstream = None
 
-        retry_delay = 0.125
+        retrier = Retrier(self.main_model.name)
 
         self.usage_report = None
         exhausted = False
@@ -1114,16 +1319,18 @@ class Coder:
             while True:
                 try:
                     yield from self.send(messages, functions=self.functions)
+                    retrier.succeeded()
                     break
                 except retry_exceptions() as err:
                     self.io.tool_error(str(err))
-                    retry_delay *= 2
-                    if retry_delay > 60:
+                    retry_delay = retrier.next_wait(err)
+                    if retry_delay is None:
                         break
                     self.io.tool_output(f"Retrying in {retry_delay:.1f} seconds...")
                     time.sleep(retry_delay)
                     continue
                 except KeyboardInterrupt:
+                    retrier.finish("interrupted")
                     interrupted = True
                     break
                 except litellm.ContextWindowExceededError:
@@ -1131,6 +1338,7 @@ class Coder:
                     exhausted = True
                     break
                 except litellm.exceptions.BadRequestError as br_err:
+                    retrier.finish("failed")
                     self.io.tool_error(f"BadRequestError: {br_err}")
                     return
                 except FinishReasonLength:
@@ -1148,6 +1356,7 @@ class Coder:
                             dict(role="assistant", content=self.multi_response_content, prefix=True)
                         )
                 except Exception as err:
+                    retrier.finish("failed")
                     self.io.tool_error(f"Unexpected error: {err}")
                     lines = traceback.format_exception(type(err), err, err.__traceback__)
                     self.io.tool_error("".join(lines))
@@ -1320,7 +1529,7 @@ class Coder:
                 )
             ]
 
-    def get_file_mentions(self, content):
+    def get_file_mentions(self, content, addable_rel_fnames=None, file_index=None):
         words = set(word for word in content.split())
 
         # drop sentence punctuation from the end
@@ -1330,29 +1539,12 @@ class Coder:
         quotes = "".join(['"', "'", "`"])
         words = set(word.strip(quotes) for word in words)
 
-        addable_rel_fnames = self.get_addable_relative_files()
-
-        mentioned_rel_fnames = set()
-        fname_to_rel_fnames = {}
-        for rel_fname in addable_rel_fnames:
-            normalized_rel_fname = rel_fname.replace("\\", "/")
-            normalized_words = set(word.replace("\\", "/") for word in words)
-            if normalized_rel_fname in normalized_words:
-                mentioned_rel_fnames.add(rel_fname)
-
-            fname = os.path.basename(rel_fname)
+        if file_index is None:
+            file_index = self.get_file_index()
+        if addable_rel_fnames is None:
+            addable_rel_fnames = self.get_addable_relative_files()
 
-            # Don't add basenames that could be plain words like "run" or "make"
-            if "/" in fname or "\\" in fname or "." in fname or "_" in fname or "-" in fname:
-                if fname not in fname_to_rel_fnames:
-                    fname_to_rel_fnames[fname] = []
-                fname_to_rel_fnames[fname].append(rel_fname)
-
-        for fname, rel_fnames in fname_to_rel_fnames.items():
-            if len(rel_fnames) == 1 and fname in words:
-                mentioned_rel_fnames.add(rel_fnames[0])
-
-        return mentioned_rel_fnames
+        return file_index.find_mentions(words, set(addable_rel_fnames))
 
     def check_for_file_mentions(self, content):
         mentioned_rel_fnames = self.get_file_mentions(content)
@@ -1384,6 +1576,8 @@ class Coder:
         self.io.log_llm_history("TO LLM", format_messages(messages))
 
         completion = None
+        self.rate_limit_reserved = self.rate_limit_tokens(model, messages)
+        tokens = self.rate_limit_reserved[1] if self.rate_limit_reserved else None
         try:
             hash_object, completion = send_completion(
                 model.name,
@@ -1393,6 +1587,7 @@ class Coder:
                 self.temperature,
                 extra_headers=model.extra_headers,
                 max_tokens=model.max_tokens,
+                tokens=tokens,
             )
             self.chat_completion_call_hashes.append(hash_object.hexdigest())
 
@@ -1419,6 +1614,11 @@ class Coder:
 
             self.calculate_and_show_tokens_and_cost(messages, completion)
 
+    def rate_limit_tokens(self, model, messages):
+        """The (model name, prompt tokens) reserved against a client side rate limit, if any."""
+        if RATE_LIMITER.is_limited(model.name):
+            return model.name, model.token_count(messages)
+
     def show_send_output(self, completion):
         if self.verbose:
             print(completion)
@@ -1495,7 +1695,7 @@ class Coder:
             try:
                 text = chunk.choices[0].delta.content
                 if text:
-                    self.partial_response_content += text
+                    self.partial_response_buffer.append(text)
             except AttributeError:
                 text = None
 
@@ -1514,6 +1714,11 @@ class Coder:
                 yield text
 
     def live_incremental_response(self, final):
+        # Check the throttle before joining the response, which costs O(size)
+        size = len(self.multi_response_content or "") + len(self.partial_response_buffer or "")
+        if not final and not self.mdstream.is_due(size):
+            return
+
         show_resp = self.render_incremental_response(final)
         self.mdstream.update(show_resp, final=final)
 
@@ -1537,19 +1742,30 @@ class Coder:
             if hasattr(completion.usage, "cache_read_input_tokens") or hasattr(
                 completion.usage, "cache_creation_input_tokens"
             ):
-                self.message_tokens_sent += prompt_tokens
-                self.message_tokens_sent += cache_hit_tokens
-                self.message_tokens_sent += cache_write_tokens
+                input_tokens = prompt_tokens + cache_hit_tokens + cache_write_tokens
             else:
-                self.message_tokens_sent += prompt_tokens
+                input_tokens = prompt_tokens
+
+            self.message_tokens_sent += input_tokens
+            self.prompt_cache_tracker.record_usage(
+                input_tokens, cache_hit_tokens or 0, cache_write_tokens or 0
+            )
         else:
             prompt_tokens = self.main_model.token_count(messages)
             completion_tokens = self.main_model.token_count(self.partial_response_content)
 
             self.message_tokens_sent += prompt_tokens
+            if self.stream:
+                self.prompt_cache_tracker.record_unmetered()
 
         self.message_tokens_received += completion_tokens
 
+        if self.stream and self.rate_limit_reserved:
+            # Streams only report their usage now, so settle the estimate reserved up front
+            model_name, reserved = self.rate_limit_reserved
+            RATE_LIMITER.settle(model_name, prompt_tokens + completion_tokens - reserved)
+            self.rate_limit_reserved = None
+
         tokens_report = f"Tokens: {format_tokens(self.message_tokens_sent)} sent"
 
         if cache_write_tokens:
@@ -1589,6 +1805,10 @@ class Coder:
         self.message_cost += cost
         self.cost = self.message_cost
 
+        # Hedged commit messages and summaries bill their cancelled requests too
+        hedge_cost = HEDGE_LEDGER.take_uncharged_cost()
+        self.total_cost += hedge_cost
+
         def format_cost(value):
             if value == 0:
                 return "0.00"
@@ -1602,6 +1822,8 @@ class Coder:
             f"Cost: ${format_cost(self.message_cost)} message,"
             f" ${format_cost(self.total_cost)} session."
         )
+        if hedge_cost:
+            cost_report += f" Includes ~${format_cost(hedge_cost)} for cancelled hedged requests."
 
         if self.add_cache_headers and self.stream:
             warning = " Use --no-stream for accurate caching costs."
@@ -1622,6 +1844,16 @@ class Coder:
             self.message_tokens_sent = 0
             self.message_tokens_received = 0
 
+        tracker = self.prompt_cache_tracker
+        if self.add_cache_headers or tracker.cache_hit_tokens or tracker.cache_write_tokens:
+            report = tracker.report()
+            if report:
+                self.io.tool_output(report)
+
+        if self.verbose:
+            for stats in RATE_LIMITER.stats() + RETRY_STATS.stats() + HEDGE_LEDGER.stats():
+                self.io.tool_output(stats)
+
     def get_multi_response_content(self, final=False):
         cur = self.multi_response_content or ""
         new = self.partial_response_content or ""
@@ -1,6 +1,18 @@
 from dataclasses import dataclass, field
 from typing import List
 
+# The chunks in the order they're sent
+ORDER = (
+    "system",
+    "examples",
+    "readonly_files",
+    "repo",
+    "done",
+    "chat_files",
+    "cur",
+    "reminder",
+)
+
 
 @dataclass
 class ChatChunks:
@@ -13,17 +25,14 @@ class ChatChunks:
     cur: List = field(default_factory=list)
     reminder: List = field(default_factory=list)
 
+    def named_chunks(self):
+        return [(name, getattr(self, name)) for name in ORDER]
+
     def all_messages(self):
-        return (
-            self.system
-            + self.examples
-            + self.readonly_files
-            + self.repo
-            + self.done
-            + self.chat_files
-            + self.cur
-            + self.reminder
-        )
+        messages = []
+        for _name, chunk in self.named_chunks():
+            messages += chunk
+        return messages
 
     def add_cache_control_headers(self):
         if self.examples:
@@ -36,6 +45,12 @@ class ChatChunks:
         else:
             self.add_cache_control(self.repo)
 
+        # Edits change the chat files every turn, while the history before them only grows
+        # until it's summarized. Its own breakpoint keeps it cached across edits.
+        # It's the coder's own list, so mark a copy.
+        self.done = list(self.done)
+        self.add_cache_control(self.done)
+
         self.add_cache_control(self.chat_files)
 
     def add_cache_control(self, messages):
@@ -50,7 +65,7 @@ class ChatChunks:
             )
         content["cache_control"] = {"type": "ephemeral"}
 
-        messages[-1]["content"] = [content]
+        messages[-1] = dict(messages[-1], content=[content])
 
     def cacheable_messages(self):
         messages = self.all_messages()
@@ -0,0 +1,66 @@
+import os
+from collections import defaultdict
+from pathlib import Path
+
+from papertlab.dump import dump  # noqa: F401
+
+
+class FileIndex:
+    """The paths, basenames and stems of the repo's files, for spotting mentions of them.
+
+    Built once per set of tracked files, so finding the files a message mentions is a few
+    set intersections against its words, not a scan of every file.
+    """
+
+    def __init__(self, rel_fnames):
+        self.rel_fnames = list(rel_fnames)
+
+        self.by_path = defaultdict(list)
+        self.by_basename = defaultdict(list)
+        self.by_stem = defaultdict(set)
+
+        for rel_fname in self.rel_fnames:
+            self.by_path[rel_fname.replace("\\", "/")].append(rel_fname)
+
+            fname = os.path.basename(rel_fname)
+
+            # Don't add basenames that could be plain words like "run" or "make"
+            if "/" in fname or "\\" in fname or "." in fname or "_" in fname or "-" in fname:
+                self.by_basename[fname].append(rel_fname)
+
+            stem = Path(rel_fname).with_suffix("").name.lower()
+            if len(stem) >= 5:
+                self.by_stem[stem].add(rel_fname)
+
+    def is_current(self, rel_fnames):
+        return rel_fnames == self.rel_fnames
+
+    def find_mentions(self, words, addable_rel_fnames):
+        """The addable files whose path, or unambiguous basename, is one of words."""
+        mentioned = set()
+
+        normalized_words = set(word.replace("\\", "/") for word in words)
+        for path in normalized_words & self.by_path.keys():
+            mentioned.update(
+                rel_fname for rel_fname in self.by_path[path] if rel_fname in addable_rel_fnames
+            )
+
+        for fname in set(words) & self.by_basename.keys():
+            rel_fnames = [
+                rel_fname
+                for rel_fname in self.by_basename[fname]
+                if rel_fname in addable_rel_fnames
+            ]
+            if len(rel_fnames) == 1:
+                mentioned.add(rel_fnames[0])
+
+        return mentioned
+
+    def find_stems(self, idents):
+        """The files whose name, less its extension, is one of idents, ignoring case."""
+        stems = set(ident.lower() for ident in idents if len(ident) >= 5)
+
+        matches = set()
+        for stem in stems & self.by_stem.keys():
+            matches.update(self.by_stem[stem])
+        return matches
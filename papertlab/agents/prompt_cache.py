@@ -0,0 +1,135 @@
+import hashlib
+import json
+
+from papertlab.dump import dump  # noqa: F401
+from papertlab.utils import format_tokens
+
+# The chunks after the last cache breakpoint are never reused, so aren't tracked
+UNCACHED_CHUNKS = ("cur", "reminder")
+
+REASONS = dict(
+    system="the system prompt changed",
+    examples="the example messages changed",
+    readonly_files="the read-only files changed",
+    repo="the repo map changed",
+    chat_files="the files in the chat changed",
+)
+
+
+def message_digest(message):
+    """A hash of a message's role and text, ignoring any cache_control markers."""
+    content = message.get("content")
+    if isinstance(content, list):
+        content = [
+            {key: value for key, value in part.items() if key != "cache_control"}
+            if isinstance(part, dict)
+            else part
+            for part in content
+        ]
+        # add_cache_control() wraps plain text as a single text part
+        part = content[0] if len(content) == 1 else None
+        if isinstance(part, dict) and part.keys() == {"type", "text"}:
+            content = part["text"]
+    data = json.dumps([message.get("role"), content], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class PromptCacheTracker:
+    """Follows how much of each prompt's prefix the provider could serve from its cache.
+
+    Each prompt's cacheable messages are hashed one by one. Comparing them with the last
+    prompt's shows where the shared prefix ends, and which chunk broke it. The session's
+    cache read and write tokens are totalled against its prompt tokens.
+
+    Streamed responses don't report their usage, so only prompts sent with --no-stream
+    count towards the totals. The others are just counted, to say so in the report.
+    """
+
+    def __init__(self):
+        self.last = None
+
+        self.prompts = 0
+        self.prefix_changes = 0
+        self.prompt_tokens = 0
+        self.cache_hit_tokens = 0
+        self.cache_write_tokens = 0
+        self.unmetered = 0
+
+    def digests(self, chunks):
+        res = []
+        for name, chunk in chunks.named_chunks():
+            if name in UNCACHED_CHUNKS:
+                continue
+            res += [(name, message_digest(message)) for message in chunk]
+        return res
+
+    def observe(self, chunks):
+        """Record the prompt about to be sent, returning why its prefix changed, if it did."""
+        digests = self.digests(chunks)
+        last, self.last = self.last, digests
+        self.prompts += 1
+
+        if last is None:
+            return
+
+        shared = 0
+        for old, new in zip(last, digests):
+            if old != new:
+                break
+            shared += 1
+
+        # Only appending to the prefix leaves what was cached reusable
+        if shared == len(last):
+            return
+
+        self.prefix_changes += 1
+
+        if shared < len(digests):
+            name = digests[shared][0]
+        else:
+            name = last[shared][0]
+
+        if name == "done":
+            old_done = [digest for chunk, digest in last if chunk == "done"]
+            new_done = [digest for chunk, digest in digests if chunk == "done"]
+            if new_done[: len(old_done)] == old_done:
+                reason = "the chat history grew ahead of later chunks"
+            else:
+                reason = "the chat history was summarized or cleared"
+        else:
+            reason = REASONS.get(name, f"the {name} chunk changed")
+
+        return (
+            f"Prompt cache prefix changed at {name}, {reason}:"
+            f" {shared} of {len(last)} cacheable messages still match."
+        )
+
+    def record_usage(self, prompt_tokens, cache_hit_tokens, cache_write_tokens):
+        self.prompt_tokens += prompt_tokens
+        self.cache_hit_tokens += cache_hit_tokens
+        self.cache_write_tokens += cache_write_tokens
+
+    def record_unmetered(self):
+        self.unmetered += 1
+
+    def report(self):
+        if not self.prompt_tokens and not self.unmetered:
+            return
+
+        if self.prompt_tokens:
+            pct = 100 * self.cache_hit_tokens / self.prompt_tokens
+            res = (
+                f"Prompt cache: {format_tokens(self.cache_hit_tokens)} of"
+                f" {format_tokens(self.prompt_tokens)} prompt tokens read from cache this"
+                f" session ({pct:.0f}%), {format_tokens(self.cache_write_tokens)} written,"
+            )
+        else:
+            res = "Prompt cache:"
+        res += f" {self.prefix_changes} prefix changes in {self.prompts} prompts."
+
+        if self.unmetered:
+            res += (
+                f" {self.unmetered} streamed responses reported no cache usage,"
+                " use --no-stream to count them."
+            )
+        return res
@@ -0,0 +1,84 @@
+import time
+
+from papertlab.dump import dump  # noqa: F401
+
+
+class TurnContext:
+    """Memoizes what the chunk builders of one prompt would otherwise each recompute.
+
+    The file listings, the mentions in the current messages and the repo map are each
+    worked out at most once, on first use. Only valid while nothing changes, so a new
+    context is made for every prompt that's built.
+    """
+
+    def __init__(self, coder, with_repo_map=True):
+        self.coder = coder
+        self.with_repo_map = with_repo_map
+        self.values = dict()
+        self.timings = dict()
+
+    def memo(self, name, compute):
+        if name not in self.values:
+            start = time.perf_counter()
+            self.values[name] = compute()
+            self.timings[name] = time.perf_counter() - start
+        return self.values[name]
+
+    def all_relative_files(self):
+        return self.memo("files", self.coder.get_all_relative_files)
+
+    def all_abs_files(self):
+        return self.memo(
+            "abs_files",
+            lambda: [self.coder.abs_root_path(path) for path in self.all_relative_files()],
+        )
+
+    def file_index(self):
+        return self.memo(
+            "file_index", lambda: self.coder.get_file_index(self.all_relative_files())
+        )
+
+    def addable_relative_files(self):
+        def compute():
+            coder = self.coder
+            inchat_files = set(coder.get_inchat_relative_files())
+            read_only_files = set(
+                coder.get_rel_fname(fname) for fname in coder.abs_read_only_fnames
+            )
+            return set(self.all_relative_files()) - inchat_files - read_only_files
+
+        return self.memo("addable_files", compute)
+
+    def cur_message_text(self):
+        return self.memo("cur_message_text", self.coder.get_cur_message_text)
+
+    def mentioned_idents(self):
+        return self.memo(
+            "mentioned_idents", lambda: self.coder.get_ident_mentions(self.cur_message_text())
+        )
+
+    def mentioned_fnames(self):
+        def compute():
+            coder = self.coder
+            mentioned = coder.get_file_mentions(
+                self.cur_message_text(),
+                addable_rel_fnames=self.addable_relative_files(),
+                file_index=self.file_index(),
+            )
+            mentioned.update(
+                coder.get_ident_filename_matches(
+                    self.mentioned_idents(), file_index=self.file_index()
+                )
+            )
+            return mentioned
+
+        return self.memo("mentioned_fnames", compute)
+
+    def repo_map(self):
+        if not self.with_repo_map:
+            return
+        return self.memo("repo_map", lambda: self.coder.get_repo_map(turn=self))
+
+    def report(self, total):
+        timings = ", ".join(f"{name} {secs:.3f}s" for name, secs in self.timings.items())
+        return f"Built prompt in {total:.3f}s" + (f" ({timings})" if timings else "")
@@ -212,12 +212,88 @@ def get_parser(default_config_files, git_root):
         default="auto",
         help="Control how often the repo map is refreshed (default: auto)",
     )
+    group.add_argument(
+        "--map-workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of processes used to extract tags when scanning the repo map, use 1 to"
+            " disable (default: number of CPUs)"
+        ),
+    )
+    group.add_argument(
+        "--map-watch",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=(
+            "Watch the repo for changes and refresh the repo map's tags in the background"
+            " (default: False)"
+        ),
+    )
+    group.add_argument(
+        "--map-cache-entries",
+        type=int,
+        default=None,
+        help="Maximum entries in each of the repo map's in-memory caches (default: 1024)",
+    )
+    group.add_argument(
+        "--map-cache-mb",
+        type=float,
+        default=None,
+        help="Maximum size in MB of each of the repo map's in-memory caches (default: 64)",
+    )
+    group.add_argument(
+        "--tags-cache-dir",
+        metavar="TAGS_CACHE_DIR",
+        default=None,
+        help=(
+            "Directory for the repo map tags cache, can be shared by several clones, worktrees"
+            " or CI runners, e.g. ~/.papertlab/tags (default: .papertlab.tags.cache.v4 in the"
+            " repo)"
+        ),
+    )
+    group.add_argument(
+        "--prebuild-prompt",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=(
+            "Build the prompt in the background while you type, so sending starts sooner"
+            " (default: False)"
+        ),
+    )
     group.add_argument(
         "--cache-prompts",
         action=argparse.BooleanOptionalAction,
         default=False,
         help="Enable caching of prompts (default: False)",
     )
+    group.add_argument(
+        "--completion-cache",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help=(
+            "Cache LLM completions on disk and replay identical requests, including streamed"
+            " ones (default: False)"
+        ),
+    )
+    group.add_argument(
+        "--completion-cache-dir",
+        metavar="COMPLETION_CACHE_DIR",
+        default="~/.papertlab.send.cache.v1",
+        help="Directory of the completion cache (default: ~/.papertlab.send.cache.v1)",
+    )
+    group.add_argument(
+        "--completion-cache-mb",
+        type=float,
+        default=1024,
+        help="Maximum size in MB of the completion cache (default: 1024)",
+    )
+    group.add_argument(
+        "--completion-cache-ttl",
+        type=int,
+        default=7 * 24 * 60 * 60,
+        help="Seconds before a cached completion expires, use 0 to never expire (default: 604800)",
+    )
     group.add_argument(
         "--cache-keepalive-pings",
         type=int,
@@ -230,6 +306,27 @@ def get_parser(default_config_files, git_root):
         default=2,
         help="Multiplier for map tokens when no files are specified (default: 2)",
     )
+    group.add_argument(
+        "--rate-limit",
+        action="append",
+        metavar="KEY=RPM:TPM",
+        default=[],
+        help=(
+            "Queue requests client side to stay under the requests and tokens per minute of a"
+            " model or provider, eg: anthropic=50:40000 or gpt-4o=:30000 (can be used multiple"
+            " times)"
+        ),
+    )
+    group.add_argument(
+        "--hedge-after",
+        type=float,
+        metavar="SECONDS",
+        default=None,
+        help=(
+            "Seconds to wait for the weak model's commit message or chat summary before racing"
+            " the next model against it, cancelling the slower one (default: try models in turn)"
+        ),
+    )
     group.add_argument(
         "--max-chat-history-tokens",
         type=int,
@@ -0,0 +1,93 @@
+import asyncio
+import atexit
+import threading
+
+from papertlab.dump import dump  # noqa: F401
+
+
+class BackgroundLoop:
+    """One long-lived event loop, in a daemon thread, for all of the process' async requests.
+
+    Objects bound to a loop, like pooled httpx clients, can then be created once and
+    shared. Synchronous code runs coroutines on it with run(), and coroutines on other
+    loops hand their work over with delegate(). Callbacks added with on_shutdown() are
+    awaited on the loop before it stops, at exit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.shutdown_callbacks = []
+
+    def get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=loop.run_forever, name="papertlab-async", daemon=True
+                )
+                self.thread.start()
+                self.loop = loop
+                atexit.register(self.shutdown)
+            return self.loop
+
+    def is_current(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def submit(self, coro):
+        """Schedule coro on the loop, returning a concurrent.futures.Future of its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.get_loop())
+
+    def run(self, coro):
+        """Run coro on the loop and wait for its result, from synchronous code."""
+        if self.is_current():
+            coro.close()
+            raise RuntimeError("Can't wait for the background loop from within it")
+        return self.submit(coro).result()
+
+    async def delegate(self, coro):
+        """Await coro on the loop, from a coroutine on some other loop."""
+        if self.is_current():
+            return await coro
+        return await asyncio.wrap_future(self.submit(coro))
+
+    async def delegate_stream(self, stream):
+        """Iterate an async iterator of the loop's, from a coroutine on some other loop."""
+        while True:
+            try:
+                item = await self.delegate(stream.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+
+    def on_shutdown(self, callback):
+        self.shutdown_callbacks.append(callback)
+
+    def shutdown(self):
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+
+        async def close():
+            for callback in self.shutdown_callbacks:
+                try:
+                    await callback()
+                except Exception:
+                    pass
+
+        try:
+            asyncio.run_coroutine_threadsafe(close(), loop).result(timeout=5)
+        except Exception:
+            pass
+
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(timeout=5)
+        self.shutdown_callbacks = []
+
+
+BACKGROUND_LOOP = BackgroundLoop()
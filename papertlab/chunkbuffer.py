@@ -0,0 +1,36 @@
+from papertlab.dump import dump  # noqa: F401
+
+
+class ChunkBuffer:
+    """Accumulates streamed text in O(1) per chunk, joining it only when it's read.
+
+    The joined string is cached until more text arrives, so reading it repeatedly
+    between appends costs nothing extra.
+    """
+
+    def __init__(self, text=""):
+        self.chunks = [text] if text else []
+        self.size = len(text)
+        self.joined = text
+
+    def append(self, text):
+        if not text:
+            return
+        self.chunks.append(text)
+        self.size += len(text)
+        self.joined = None
+
+    def getvalue(self):
+        if self.joined is None:
+            self.joined = "".join(self.chunks)
+            self.chunks = [self.joined]
+        return self.joined
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+    def __str__(self):
+        return self.getvalue()
@@ -178,7 +178,7 @@ def initialize_coder():
             raise ValueError("Failed to initialize Coder")
         # Use the current_model if it's set, otherwise use DEFAULT_MODEL
         model_to_use = current_model or get_available_models()[0] if len(get_available_models()) >= 1 else DEFAULT_MODEL_NAME
-        coder.main_model = models.Model(model_to_use)
+        coder.main_model = models.get_model(model_to_use)
         print("Coder initialized successfully")
     except Exception as e:
         print(f"Error initializing Coder: {str(e)}")
@@ -301,7 +301,7 @@ def set_model():
 
         try:
             update_current_model(new_model)
-            coder.main_model = models.Model(new_model)
+            coder.main_model = models.get_model(new_model)
             # Create a new coder instance with the new model
             # new_coder = cli_main(return_coder=True)
             # new_coder.main_model = models.Model(new_model)
@@ -648,7 +648,7 @@ def check_new_files():
                 all_files.append(relative_path.replace('\\', '/'))
 
         # Filter out any unwanted files or directories
-        excluded_patterns = ['.git', '__pycache__', '.vscode', '.idea', '.papertlab.tags.cache.v3', '.papertlab.chat.history.md']
+        excluded_patterns = ['.git', '__pycache__', '.vscode', '.idea', '.papertlab.tags.cache.v4', '.papertlab.chat.history.md']
         filtered_files = [f for f in all_files if not any(pattern in f for pattern in excluded_patterns)]
 
         # Create a file structure
@@ -0,0 +1,144 @@
+import asyncio
+import threading
+from collections import defaultdict
+
+from papertlab.asyncloop import BACKGROUND_LOOP
+from papertlab.dump import dump  # noqa: F401
+from papertlab.sendchat import async_simple_send_with_retries
+
+
+class HedgeLedger:
+    """Per model totals of the hedged requests sent, won and cancelled.
+
+    A cancelled request has usually been billed for its prompt already, so its spend is
+    estimated as the prompt tokens at the model's input price. The coder adds that spend
+    to the session's cost with take_uncharged_cost().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.requests = defaultdict(int)
+            self.wins = defaultdict(int)
+            self.cancelled = defaultdict(int)
+            self.cancelled_tokens = defaultdict(int)
+            self.cancelled_cost = defaultdict(float)
+            self.uncharged_cost = 0.0
+
+    def record_request(self, model):
+        with self.lock:
+            self.requests[model.name] += 1
+
+    def record_win(self, model):
+        with self.lock:
+            self.wins[model.name] += 1
+
+    def record_cancel(self, model, prompt_tokens):
+        cost = prompt_tokens * (model.info.get("input_cost_per_token") or 0)
+        with self.lock:
+            self.cancelled[model.name] += 1
+            self.cancelled_tokens[model.name] += prompt_tokens
+            self.cancelled_cost[model.name] += cost
+            self.uncharged_cost += cost
+        return cost
+
+    def total_cancelled_cost(self):
+        with self.lock:
+            return sum(self.cancelled_cost.values())
+
+    def take_uncharged_cost(self):
+        """The cancelled spend since the last call."""
+        with self.lock:
+            cost, self.uncharged_cost = self.uncharged_cost, 0.0
+            return cost
+
+    def stats(self):
+        res = []
+        with self.lock:
+            for name in self.requests:
+                res.append(
+                    f"Hedging {name}: {self.requests[name]} requests, {self.wins[name]} won,"
+                    f" {self.cancelled[name]} cancelled"
+                    f" (~{self.cancelled_tokens[name]} prompt tokens,"
+                    f" ~${self.cancelled_cost[name]:.4f})"
+                )
+        return res
+
+
+HEDGE_LEDGER = HedgeLedger()
+
+
+def distinct_models(models):
+    """The models in order, without repeats of a name, like a weak model which is the main one."""
+    res = dict()
+    for model in models:
+        res.setdefault(model.name, model)
+    return list(res.values())
+
+
+async def hedged_send(models, messages, hedge_after, accept=bool, ledger=HEDGE_LEDGER):
+    """Send messages to models in order, hedging slow requests with the next model.
+
+    The first model is sent the request straight away. Each time `hedge_after` seconds
+    pass without an acceptable answer, or as soon as a request fails, the next model is
+    raced against the ones still pending. The first answer which `accept` approves wins,
+    the rest are cancelled and their estimated spend recorded in the ledger.
+
+    Returns (model, answer), or (None, None) if no model gave an acceptable answer.
+    """
+    pending = dict()
+    queue = list(models)
+
+    def start_next():
+        model = queue.pop(0)
+        task = asyncio.ensure_future(
+            async_simple_send_with_retries(model.name, messages, extra_headers=model.extra_headers)
+        )
+        pending[task] = model
+        ledger.record_request(model)
+
+    start_next()
+    try:
+        while pending:
+            timeout = hedge_after if queue else None
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            failed = not done
+            for task in done:
+                model = pending.pop(task)
+                try:
+                    answer = task.result()
+                except Exception as err:
+                    print(f"Request to {model.name} failed: {err}")
+                    failed = True
+                    continue
+
+                if accept(answer):
+                    ledger.record_win(model)
+                    return model, answer
+                failed = True
+
+            if queue and (failed or not pending):
+                start_next()
+    finally:
+        for task, model in pending.items():
+            task.cancel()
+            ledger.record_cancel(model, model.token_count(messages))
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    return None, None
+
+
+def hedged_send_sync(models, messages, hedge_after, accept=bool, ledger=HEDGE_LEDGER):
+    """Run hedged_send() to completion from synchronous code.
+
+    The race runs on the shared background loop, so it reuses its pooled connections.
+    """
+    coro = hedged_send(models, messages, hedge_after, accept=accept, ledger=ledger)
+    return BACKGROUND_LOOP.run(coro)
@@ -2,15 +2,17 @@ import argparse
 
 from papertlab import models, prompts
 from papertlab.dump import dump  # noqa: F401
+from papertlab.hedge import distinct_models, hedged_send_sync
 from papertlab.sendchat import simple_send_with_retries
 
 
 class ChatSummary:
-    def __init__(self, models=None, max_tokens=1024):
+    def __init__(self, models=None, max_tokens=1024, hedge_after=None):
         if not models:
             raise ValueError("At least one model must be provided")
         self.models = models if isinstance(models, list) else [models]
         self.max_tokens = max_tokens
+        self.hedge_after = hedge_after
         self.token_count = self.models[0].token_count
 
     def too_big(self, messages):
@@ -106,6 +108,19 @@ class ChatSummary:
             dict(role="user", content=content),
         ]
 
+        hedge_models = distinct_models(self.models)
+        if self.hedge_after is not None and len(hedge_models) > 1:
+            _model, summary = hedged_send_sync(
+                hedge_models,
+                summarize_messages,
+                self.hedge_after,
+                accept=lambda answer: answer is not None,
+            )
+            if summary is not None:
+                summary = prompts.summary_prefix + summary
+                return [dict(role="user", content=summary)]
+            raise ValueError("summarizer unexpectedly failed for all models")
+
         for model in self.models:
             try:
                 summary = simple_send_with_retries(
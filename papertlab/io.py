@@ -1,6 +1,9 @@
 import base64
 import os
+import threading
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
@@ -20,6 +23,7 @@ from rich.style import Style as RichStyle
 from rich.text import Text
 
 from .dump import dump  # noqa: F401
+from .lru import LRUCache
 from .utils import is_image_file
 
 
@@ -164,6 +168,11 @@ class InputOutput:
     num_error_outputs = 0
     num_user_asks = 0
 
+    # Chat files are read several times for every prompt, see cached_read(). The repo map
+    # reads around it, so this only has to hold the chat and read-only files.
+    content_cache_mb = 32
+    racy_seconds = 2
+
     def __init__(
         self,
         pretty=True,
@@ -208,6 +217,15 @@ class InputOutput:
         self.encoding = encoding
         self.dry_run = dry_run
 
+        # Per thread state, so background work can be kept off the console
+        self.local = threading.local()
+
+        self.content_cache = LRUCache(
+            max_bytes=self.content_cache_mb * 1024 * 1024,
+            sizeof=lambda entry: len(entry[1]),
+            name="file contents",
+        )
+
         if pretty:
             self.console = Console()
         else:
@@ -216,7 +234,42 @@ class InputOutput:
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         self.append_chat_history(f"\n# papertlab chat started at {current_time}\n\n")
 
+    def content_stamp(self, filename):
+        """The (path, stamp) a cached read of filename is valid for.
+
+        The stamp is None if the file can't be stat'ed, or if it was modified so recently
+        that it could change again without its mtime changing, like git's racily clean
+        index entries. Such files are always read from disk.
+        """
+        path = os.path.abspath(str(filename))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return path, None
+
+        if time.time() - st.st_mtime < self.racy_seconds:
+            return path, None
+        return path, (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def cached_read(self, filename, read):
+        """Return read(filename), reusing its last result while the file is unchanged."""
+        path, stamp = self.content_stamp(filename)
+        if stamp is not None:
+            entry = self.content_cache.get(path)
+            if entry and entry[0] == stamp:
+                return entry[1]
+
+        content = read(filename)
+        if content is None:
+            self.content_cache.pop(path)
+        elif stamp is not None:
+            self.content_cache[path] = (stamp, content)
+        return content
+
     def read_image(self, filename):
+        return self.cached_read(filename, self.read_image_uncached)
+
+    def read_image_uncached(self, filename):
         try:
             with open(str(filename), "rb") as image_file:
                 encoded_string = base64.b64encode(image_file.read())
@@ -235,6 +288,9 @@ class InputOutput:
         if is_image_file(filename):
             return self.read_image(filename)
 
+        return self.cached_read(filename, self.read_text_uncached)
+
+    def read_text_uncached(self, filename):
         try:
             with open(str(filename), "r", encoding=self.encoding) as f:
                 return f.read()
@@ -252,6 +308,7 @@ class InputOutput:
     def write_text(self, filename, content):
         if self.dry_run:
             return
+        self.content_cache.pop(os.path.abspath(str(filename)))
         with open(str(filename), "w", encoding=self.encoding) as f:
             f.write(content)
 
@@ -505,7 +562,22 @@ class InputOutput:
 
         return res
 
+    @contextmanager
+    def quietly(self):
+        """Drop the tool messages of this thread, which mustn't print over the input."""
+        self.local.quiet = True
+        try:
+            yield
+        finally:
+            self.local.quiet = False
+
+    def is_quiet(self):
+        return getattr(self.local, "quiet", False)
+
     def tool_error(self, message="", strip=True):
+        if self.is_quiet():
+            return
+
         self.num_error_outputs += 1
 
         if message.strip():
@@ -524,6 +596,9 @@ class InputOutput:
         self.console.print(message, **style)
 
     def tool_output(self, *messages, log_only=False, bold=False):
+        if self.is_quiet():
+            return
+
         if messages:
             hist = " ".join(messages)
             hist = f"{hist.strip()}"
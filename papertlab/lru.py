@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+
+from papertlab.dump import dump  # noqa: F401
+
+
+def default_sizeof(value):
+    try:
+        return len(value)
+    except TypeError:
+        return 1
+
+
+class LRUCache:
+    """A dict-like cache which evicts its least recently used entries.
+
+    Bounded by max_entries and/or max_bytes, either may be None for no limit. The size
+    of each value is estimated by sizeof(value), which defaults to its len(). Safe to
+    share between threads.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None, name="cache"):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or default_sizeof
+        self.name = name
+
+        self.lock = threading.RLock()
+        self.data = OrderedDict()
+        self.sizes = dict()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        with self.lock:
+            value = self.data[key]
+            self.data.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        """Look up key, counting the hit or miss."""
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            return self[key]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.data:
+                self.pop(key)
+
+            self.data[key] = value
+            self.sizes[key] = size
+            self.total_bytes += size
+
+            self.evict()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+
+            self.total_bytes -= self.sizes.pop(key)
+            return self.data.pop(key)
+
+    def evict(self):
+        # Always keep the newest entry, even if it alone is over max_bytes
+        with self.lock:
+            while len(self.data) > 1 and self.over_limit():
+                key = next(iter(self.data))
+                self.pop(key)
+                self.evictions += 1
+
+    def over_limit(self):
+        if self.max_entries is not None and len(self.data) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            return True
+        return False
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return (
+                f"{self.name}: {len(self)} entries, {self.total_bytes / 1024 / 1024:.1f} MB,"
+                f" {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+            )
@@ -9,7 +9,7 @@ import git
 from dotenv import load_dotenv
 from prompt_toolkit.enums import EditingMode
 
-from papertlab import __version__, models, utils
+from papertlab import __version__, models, ratelimit, sendchat, utils
 from papertlab.args import get_parser
 from papertlab.agents import Coder
 from papertlab.agents.base_coder import DB_PATH
@@ -118,7 +118,7 @@ def check_gitignore(git_root, io, ask=True):
         pass
 
     pat = ".papertlab.chat.history.md"
-    pat_cache = ".papertlab.tags.cache.v3"
+    pat_cache = ".papertlab.tags.cache.v4"
     pat_db = "papertlab_gui.db"
 
     gitignore_file = Path(git_root) / ".gitignore"
@@ -449,6 +449,24 @@ def main(argv=None, input=None, output=None, force_git_root=None, return_coder=F
     if args.openai_organization_id:
         os.environ["OPENAI_ORGANIZATION"] = args.openai_organization_id
 
+    if args.completion_cache:
+        try:
+            sendchat.enable_cache(
+                args.completion_cache_dir,
+                args.completion_cache_mb,
+                args.completion_cache_ttl or None,
+            )
+        except Exception as err:
+            io.tool_error(f"Unable to use completion cache {args.completion_cache_dir}: {err}")
+
+    for spec in args.rate_limit:
+        try:
+            key, rpm, tpm = ratelimit.parse_rate_limit(spec)
+        except ValueError as err:
+            io.tool_error(str(err))
+            return 1
+        ratelimit.RATE_LIMITER.set_limit(key, rpm, tpm)
+
     register_models(git_root, args.model_settings_file, io, verbose=args.verbose)
     register_litellm_models(git_root, args.model_metadata_file, io, verbose=args.verbose)
 
@@ -457,7 +475,7 @@ def main(argv=None, input=None, output=None, force_git_root=None, return_coder=F
         if os.environ.get("OPENAI_API_TYPE"):
             args.model = "gpt-4o"
 
-    main_model = models.Model(args.model, weak_model=args.weak_model)
+    main_model = models.get_model(args.model, weak_model=args.weak_model)
 
     if args.verbose:
         io.tool_output("Model info:")
@@ -491,6 +509,7 @@ def main(argv=None, input=None, output=None, force_git_root=None, return_coder=F
                 attribute_commit_message_author=args.attribute_commit_message_author,
                 attribute_commit_message_committer=args.attribute_commit_message_committer,
                 commit_prompt=args.commit_prompt,
+                hedge_after=args.hedge_after,
             )
         except FileNotFoundError:
             pass
@@ -503,6 +522,7 @@ def main(argv=None, input=None, output=None, force_git_root=None, return_coder=F
     summarizer = ChatSummary(
         [main_model.weak_model, main_model],
         args.max_chat_history_tokens or main_model.max_chat_history_tokens,
+        hedge_after=args.hedge_after,
     )
 
     if args.cache_prompts and args.map_refresh == "auto":
@@ -534,10 +554,16 @@ def main(argv=None, input=None, output=None, force_git_root=None, return_coder=F
             commands=commands,
             summarizer=summarizer,
             map_refresh=args.map_refresh,
+            map_workers=args.map_workers,
+            tags_cache_dir=args.tags_cache_dir,
+            map_watch=args.map_watch,
+            map_cache_entries=args.map_cache_entries,
+            map_cache_mb=args.map_cache_mb,
             cache_prompts=args.cache_prompts,
             map_mul_no_files=args.map_multiplier_no_files,
             num_cache_warming_pings=args.cache_keepalive_pings,
             suggest_shell_commands=args.suggest_shell_commands,
+            prebuild_prompt=args.prebuild_prompt,
         )
 
     except ValueError as err:
@@ -663,6 +689,7 @@ def load_slow_imports():
         import litellm  # noqa: F401
         import networkx  # noqa: F401
         import numpy  # noqa: F401
+        import scipy.sparse  # noqa: F401
     except Exception:
         pass
 
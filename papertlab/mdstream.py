@@ -46,6 +46,13 @@ class MarkdownStream:
     min_delay = 0.050
     live_window = 6
 
+    # Rendering is O(size) in the whole text, so wait for it to grow by this fraction and
+    # keep rendering to about 1/render_ratio of the wall clock time
+    min_growth = 0.02
+    render_ratio = 4
+    delay = min_delay
+    size = 0
+
     def __init__(self, mdargs=None):
         self.printed = []
 
@@ -64,12 +71,26 @@ class MarkdownStream:
             except Exception:
                 pass
 
+    def is_due(self, size):
+        """Whether text of this size should be rendered yet, or throttled."""
+        if time.time() - self.when < self.delay:
+            return False
+        return size - self.size >= self.min_growth * self.size
+
     def update(self, text, final=False):
         now = time.time()
-        if not final and now - self.when < self.min_delay:
+        if not final and not self.is_due(len(text)):
             return
         self.when = now
+        self.size = len(text)
+
+        try:
+            self.render(text, final)
+        finally:
+            elapsed = time.time() - now
+            self.delay = max(self.min_delay, elapsed * self.render_ratio)
 
+    def render(self, text, final):
         string_io = io.StringIO()
         console = Console(file=string_io, force_terminal=True)
 
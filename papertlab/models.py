@@ -1,10 +1,14 @@
 import difflib
+import hashlib
 import json
+import marshal
 import math
 import os
 import platform
 import sys
+import threading
 import time
+from collections import defaultdict
 from dataclasses import dataclass, fields
 from pathlib import Path
 from typing import Optional
@@ -16,10 +20,18 @@ from PIL import Image
 from papertlab import urls
 from papertlab.dump import dump  # noqa: F401
 from papertlab.llm import litellm
+from papertlab.lru import LRUCache
 
 DEFAULT_MODEL_NAME = "claude-3-5-sonnet-20240620"
 ANTHROPIC_BETA_HEADER = "max-tokens-3-5-sonnet-2024-07-15,prompt-caching-2024-07-31"
 
+# Chat format overhead, as litellm.token_counter() counts it for OpenAI models
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+TOKEN_CACHE_ENTRIES = 10000
+
 OPENAI_MODELS = """
 gpt-4
 gpt-4o
@@ -468,52 +480,169 @@ model_info_url = (
 )
 
 
-def get_model_flexible(model, content):
-    info = content.get(model, dict())
-    if info:
-        return info
+def content_key(text):
+    """A compact, collision resistant cache key for a string."""
+    return hashlib.sha1(text.encode("utf-8", "surrogateescape")).digest()
 
-    pieces = model.split("/")
-    if len(pieces) == 2:
-        info = content.get(pieces[1])
-        if info and info.get("litellm_provider") == pieces[0]:
-            return info
 
-    return dict()
+class ModelInfoStore:
+    """litellm's model metadata, compiled into an index loaded once per process.
 
+    The downloaded model_prices_and_context_window.json is compiled into a marshal
+    file mapping both "model" and "provider/model" names to their info, so a lookup is
+    a single dict access. Lookups never touch the network. When the download is more
+    than a day old it is refreshed in a background thread, which swaps in the new
+    index. Dropping a newer json into the cache dir out of band also works, it is
+    recompiled the next time a process loads the store.
+    """
 
-def get_model_info(model):
-    if not litellm._lazy_module:
-        cache_dir = Path.home() / ".papertlab" / "caches"
-        cache_file = cache_dir / "model_prices_and_context_window.json"
-        cache_dir.mkdir(parents=True, exist_ok=True)
+    INDEX_VERSION = 1
+    max_age = 60 * 60 * 24
 
-        current_time = time.time()
-        cache_age = (
-            current_time - cache_file.stat().st_mtime if cache_file.exists() else float("inf")
-        )
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = Path.home() / ".papertlab" / "caches"
+        self.cache_dir = Path(cache_dir)
+        self.json_file = self.cache_dir / "model_prices_and_context_window.json"
+        self.index_file = self.cache_dir / f"model_info.v{self.INDEX_VERSION}.marshal"
+
+        self.index = None
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+        self.allow_refresh = True
+
+    def get(self, model):
+        if self.index is None:
+            self.load()
+
+        info = self.index.get(model)
+        if info:
+            return dict(info)
+        return dict()
+
+    def load(self):
+        with self.lock:
+            if self.index is not None:
+                return
+
+            index = self.read_index()
+            if index is None:
+                index = self.compile()
+            self.index = index or dict()
+
+        if self.allow_refresh and self.is_stale():
+            self.refresh_in_background()
+
+    def get_json_mtime(self):
+        try:
+            return self.json_file.stat().st_mtime
+        except OSError:
+            return
+
+    def is_stale(self):
+        json_mtime = self.get_json_mtime()
+        return json_mtime is None or time.time() - json_mtime > self.max_age
+
+    def read_index(self):
+        json_mtime = self.get_json_mtime()
+        if json_mtime is None:
+            return
+
+        try:
+            data = marshal.loads(self.index_file.read_bytes())
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+
+        # The json was replaced since the index was compiled
+        if data.get("json_mtime") != json_mtime:
+            return
+
+        return data.get("index")
 
-        if cache_age < 60 * 60 * 24:
+    def compile(self, content=None):
+        """Build the index from the json, saving it for the next process."""
+        json_mtime = self.get_json_mtime()
+        if content is None:
+            if json_mtime is None:
+                return
             try:
-                content = json.loads(cache_file.read_text())
-                res = get_model_flexible(model, content)
-                if res:
-                    return res
-            except Exception as ex:
+                content = json.loads(self.json_file.read_text())
+            except (OSError, ValueError) as ex:
                 print(str(ex))
+                return
 
-        import requests
+        index = dict()
 
+        # Also find "provider/model" under "model", if that is the provider it lists.
+        # Exact names take precedence.
+        for name, info in content.items():
+            if not isinstance(info, dict):
+                continue
+            provider = info.get("litellm_provider")
+            if provider and "/" not in name:
+                index[f"{provider}/{name}"] = info
+
+        for name, info in content.items():
+            if isinstance(info, dict):
+                index[name] = info
+
+        data = dict(json_mtime=json_mtime, index=index)
+        try:
+            write_atomic(self.index_file, marshal.dumps(data))
+        except (OSError, ValueError):
+            pass
+
+        return index
+
+    def refresh_in_background(self):
+        if self.refresh_thread and self.refresh_thread.is_alive():
+            return
+
+        self.refresh_thread = threading.Thread(target=self.refresh, daemon=True)
+        self.refresh_thread.start()
+
+    def refresh(self):
+        """Download the latest model metadata and swap in its index.
+
+        Safe to call out of band, eg from a cron job or a CI image build.
+        """
         try:
-            response = requests.get(model_info_url, timeout=5)
-            if response.status_code == 200:
-                content = response.json()
-                cache_file.write_text(json.dumps(content, indent=4))
-                res = get_model_flexible(model, content)
-                if res:
-                    return res
-        except Exception as ex:
-            print(str(ex))
+            import requests
+
+            response = requests.get(model_info_url, timeout=10)
+            if response.status_code != 200:
+                return False
+            content = response.json()
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            write_atomic(self.json_file, json.dumps(content, indent=4).encode())
+        except Exception:
+            return False
+
+        index = self.compile(content)
+        if index is None:
+            return False
+
+        with self.lock:
+            self.index = index
+        return True
+
+
+def write_atomic(fname, data):
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fname.with_name(f"{fname.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, fname)
+
+
+MODEL_INFO = ModelInfoStore()
+
+
+def get_model_info(model):
+    if not litellm._lazy_module:
+        res = MODEL_INFO.get(model)
+        if res:
+            return res
 
     # If all else fails, do it the slow way...
     try:
@@ -521,14 +650,21 @@ def get_model_info(model):
         return info
     except Exception:
         return dict()
-    
+
+
 class Model(ModelSettings):
+    # Set on the shared instances handed out by get_model()
+    frozen = False
+
     def __init__(self, model, weak_model=None):
 
         self.name = model
         self.max_chat_history_tokens = 1024
         self.weak_model = None
 
+        # Token counts of texts and messages, keyed by content hash
+        self.token_cache = LRUCache(max_entries=TOKEN_CACHE_ENTRIES, name="token_cache")
+
         self.info = self.get_model_info(model)
 
         # Are all needed keys/params available?
@@ -549,6 +685,17 @@ class Model(ModelSettings):
         else:
             self.get_weak_model(weak_model)
 
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError(f"Model {self.name} is shared, its settings are read-only")
+        super().__setattr__(name, value)
+
+    def refresh_environment(self):
+        """Recheck the keys/params, which may have been set since the model was made."""
+        res = self.validate_environment()
+        object.__setattr__(self, "missing_keys", res.get("missing_keys"))
+        object.__setattr__(self, "keys_in_environment", res.get("keys_in_environment"))
+
     def get_model_info(self, model):
         return get_model_info(model)
 
@@ -611,7 +758,7 @@ class Model(ModelSettings):
             self.weak_model = self
             return
 
-        self.weak_model = Model(
+        self.weak_model = get_model(
             self.weak_model_name,
             weak_model=False,
         )
@@ -625,12 +772,8 @@ class Model(ModelSettings):
 
     def token_count(self, messages):
         if type(messages) is list:
-            try:
-                return litellm.token_counter(model=self.name, messages=messages)
-            except Exception as err:
-                print(f"Unable to count tokens: {err}")
-                return 0
-        
+            return self.token_count_messages(messages)
+
         if not self.tokenizer:
             return
 
@@ -639,12 +782,67 @@ class Model(ModelSettings):
         else:
             msgs = json.dumps(messages)
 
+        return self.token_count_text(msgs)
+
+    def token_count_text(self, text):
+        key = content_key(text)
+        num_tokens = self.token_cache.get(key)
+        if num_tokens is not None:
+            return num_tokens
+
         try:
-            return len(self.tokenizer(msgs))
+            num_tokens = len(self.tokenizer(text))
         except Exception as err:
             print(f"Unable to count tokens: {err}")
             return 0
 
+        self.token_cache[key] = num_tokens
+        return num_tokens
+
+    def token_count_messages(self, messages):
+        """Count a list of chat messages as the sum of each message's memoized count.
+
+        So only messages which are new since the last count get tokenized.
+        """
+        num_tokens = TOKENS_PER_REPLY
+        for message in messages:
+            num_tokens += self.token_count_message(message)
+        return num_tokens
+
+    def token_count_message(self, message):
+        content = message.get("content")
+        if content is not None and type(content) is not str:
+            # Images and other multi-part content, leave them to litellm
+            return self.token_count_multipart(message)
+
+        num_tokens = TOKENS_PER_MESSAGE
+        for key, value in message.items():
+            if value is None:
+                continue
+            if type(value) is not str:
+                value = json.dumps(value)
+            num_tokens += self.token_count_text(value)
+            if key == "name":
+                num_tokens += TOKENS_PER_NAME
+        return num_tokens
+
+    def token_count_multipart(self, message):
+        key = content_key(json.dumps(message, sort_keys=True))
+        num_tokens = self.token_cache.get(key)
+        if num_tokens is not None:
+            return num_tokens
+
+        try:
+            num_tokens = litellm.token_counter(model=self.name, messages=[message])
+        except Exception as err:
+            print(f"Unable to count tokens: {err}")
+            return 0
+
+        # token_counter() includes the reply priming, which token_count_messages() adds once
+        num_tokens = max(num_tokens - TOKENS_PER_REPLY, 0)
+        self.token_cache[key] = num_tokens
+        return num_tokens
+
     def token_count_for_image(self, fname):
         """
         Calculate the token cost for an image assuming high detail.
@@ -724,6 +922,35 @@ class Model(ModelSettings):
         return res
 
 
+MODEL_REGISTRY = dict()
+MODEL_REGISTRY_LOCK = threading.RLock()
+
+
+def get_model(model, weak_model=None):
+    """Return the shared Model for (model, weak_model), creating it on first use.
+
+    The instances are shared process-wide, so their settings are frozen. Only their
+    environment checks are redone, as API keys can be set while running, eg: by the GUI.
+    """
+    key = (model, weak_model)
+    with MODEL_REGISTRY_LOCK:
+        res = MODEL_REGISTRY.get(key)
+        if res is None:
+            res = Model(model, weak_model=weak_model)
+            object.__setattr__(res, "frozen", True)
+            MODEL_REGISTRY[key] = res
+        else:
+            res.refresh_environment()
+            if res.weak_model and res.weak_model is not res:
+                res.weak_model.refresh_environment()
+    return res
+
+
+def clear_model_registry():
+    with MODEL_REGISTRY_LOCK:
+        MODEL_REGISTRY.clear()
+
+
 def register_models(model_settings_fnames):
     files_loaded = []
     for model_settings_fname in model_settings_fnames:
@@ -747,6 +974,9 @@ def register_models(model_settings_fnames):
             raise Exception(f"Error loading model settings from {model_settings_fname}: {e}")
         files_loaded.append(model_settings_fname)
 
+    if files_loaded:
+        clear_model_registry()
+
     return files_loaded
 
 
@@ -761,6 +991,8 @@ def register_litellm_models(model_fnames):
                 model_def = json5.load(model_def_file)
             litellm._load_litellm()
             litellm.register_model(model_def)
+            MODEL_NAMES.invalidate()
+            clear_model_registry()
         except Exception as e:
             raise Exception(f"Error loading model definition from {model_fname}: {e}")
 
@@ -826,43 +1058,117 @@ def sanity_check_model(io, model):
     return show
 
 
-def fuzzy_match_models(name):
-    name = name.lower()
+class ModelNameIndex:
+    """Trigram and bigram indexes of litellm's chat model names, for fuzzy_match_models().
+
+    Built on first use, and rebuilt if litellm.model_cost changes, eg after
+    register_litellm_models().
+    """
+
+    def __init__(self):
+        self.names = []
+        self.postings = dict()
+        self.bigram_postings = dict()
+        self.key = None
+
+    def get_key(self):
+        model_cost = litellm.model_cost
+        return (id(model_cost), len(model_cost))
+
+    def invalidate(self):
+        self.key = None
+
+    def build(self):
+        chat_models = set()
+        for model, attrs in litellm.model_cost.items():
+            model = model.lower()
+            if attrs.get("mode") != "chat":
+                continue
+            provider = (attrs["litellm_provider"] + "/").lower()
+
+            if model.startswith(provider):
+                fq_model = model
+            else:
+                fq_model = provider + model
+
+            chat_models.add(fq_model)
+            chat_models.add(model)
+
+        self.names = sorted(chat_models)
+
+        postings = defaultdict(set)
+        bigram_postings = defaultdict(set)
+        for idx, model in enumerate(self.names):
+            for trigram in trigrams(model):
+                postings[trigram].add(idx)
+            for bigram in bigrams(model):
+                bigram_postings[bigram].add(idx)
+        self.postings = postings
+        self.bigram_postings = bigram_postings
+
+    def ensure_built(self):
+        key = self.get_key()
+        if key != self.key:
+            self.build()
+            self.key = key
+
+    def candidates(self, name):
+        """Indexes of the names which share trigrams with name, None if name is too short."""
+        grams = trigrams(name)
+        if not grams:
+            return
 
-    chat_models = set()
-    for model, attrs in litellm.model_cost.items():
-        model = model.lower()
-        if attrs.get("mode") != "chat":
-            continue
-        provider = (attrs["litellm_provider"] + "/").lower()
+        return [self.postings.get(trigram, set()) for trigram in grams]
+
+    def search(self, name):
+        name = name.lower()
+        self.ensure_built()
+
+        postings = self.candidates(name)
 
-        if model.startswith(provider):
-            fq_model = model
+        # Check for model names containing the name
+        if postings is None:
+            matching_models = [m for m in self.names if name in m]
         else:
-            fq_model = provider + model
-
-        chat_models.add(fq_model)
-        chat_models.add(model)
-
-    chat_models = sorted(chat_models)
-    # exactly matching model
-    # matching_models = [
-    #    (fq,m) for fq,m in chat_models
-    #    if name == fq or name == m
-    # ]
-    # if matching_models:
-    #    return matching_models
-
-    # Check for model names containing the name
-    matching_models = [m for m in chat_models if name in m]
-    if matching_models:
+            postings = sorted(postings, key=len)
+            found = set.intersection(*postings) if postings[0] else set()
+            matching_models = [self.names[idx] for idx in found if name in self.names[idx]]
+        if matching_models:
+            return sorted(set(matching_models))
+
+        # Check for slight misspellings. With single character matches alone, a ratio() of
+        # 0.8 needs a name of 5 characters or less, so longer ones always share a bigram.
+        if len(name) <= 5:
+            found = range(len(self.names))
+        else:
+            found = set().union(
+                *(self.bigram_postings.get(bigram, set()) for bigram in bigrams(name))
+            )
+
+        # A ratio() of 0.8 is impossible unless the lengths are within 2/3 of each other
+        shortest = len(name) * 2 / 3
+        longest = len(name) * 3 / 2
+        models = [
+            self.names[idx] for idx in found if shortest <= len(self.names[idx]) <= longest
+        ]
+        matching_models = difflib.get_close_matches(name, models, n=3, cutoff=0.8)
+
         return sorted(set(matching_models))
 
-    # Check for slight misspellings
-    models = set(chat_models)
-    matching_models = difflib.get_close_matches(name, models, n=3, cutoff=0.8)
 
-    return sorted(set(matching_models))
+def trigrams(text):
+    return set(text[i : i + 3] for i in range(len(text) - 2))
+
+
+def bigrams(text):
+    return set(text[i : i + 2] for i in range(len(text) - 1))
+
+
+MODEL_NAMES = ModelNameIndex()
+
+
+def fuzzy_match_models(name):
+    return MODEL_NAMES.search(name)
 
 
 def print_matching_models(io, search):
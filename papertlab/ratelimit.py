@@ -0,0 +1,196 @@
+import asyncio
+import threading
+import time
+
+from papertlab.dump import dump  # noqa: F401
+from papertlab.llm import litellm
+
+
+class TokenBucket:
+    """Refills continuously at per_minute units a minute, holding at most a minute's worth.
+
+    Reservations are allowed to overdraw the bucket. The caller waits out the deficit, so
+    concurrent callers queue up in the order they reserved.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount from the bucket, returning the seconds to wait before using it."""
+        self.refill(now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0
+        return -self.level / self.rate
+
+    def adjust(self, amount):
+        self.level -= amount
+
+
+class RateLimit:
+    def __init__(self, key, rpm=None, tpm=None):
+        self.key = key
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+        self.num_requests = 0
+        self.num_waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def reserve(self, tokens):
+        now = time.monotonic()
+        wait = 0
+        if self.requests:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens, now))
+
+        self.num_requests += 1
+        if wait:
+            self.num_waits += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        return wait
+
+    def stats(self):
+        avg = self.total_wait / self.num_requests if self.num_requests else 0
+        return (
+            f"Rate limit {self.key}: {self.num_requests} requests, {self.num_waits} queued,"
+            f" {self.total_wait:.1f}s total wait, {avg:.2f}s average, {self.max_wait:.1f}s max"
+        )
+
+
+class RateLimiter:
+    """Client side requests and tokens per minute limits, shared by every send in the process.
+
+    Limits are keyed by a model name or by a provider, like "anthropic", which covers all
+    of its models that have no limit of their own. Models without a limit are not slowed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = dict()
+        self.provider_keys = dict()
+
+    def set_limit(self, key, rpm=None, tpm=None):
+        with self.lock:
+            if rpm or tpm:
+                self.limits[key] = RateLimit(key, rpm, tpm)
+            else:
+                self.limits.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.limits.clear()
+
+    def get_provider(self, model_name):
+        """The litellm provider serving model_name, or "" if it can't be told (yet)."""
+        if "/" in model_name:
+            return model_name.split("/", 1)[0]
+
+        provider = self.provider_keys.get(model_name)
+        if provider:
+            return provider
+
+        from papertlab.models import get_model_info
+
+        provider = get_model_info(model_name).get("litellm_provider")
+        if not provider:
+            try:
+                provider = litellm.get_llm_provider(model_name)[1]
+            except Exception:
+                provider = None
+
+        # Misses aren't remembered, the model metadata may not have been loaded yet
+        if provider:
+            self.provider_keys[model_name] = provider
+        return provider or ""
+
+    def get_limit(self, model_name):
+        if not self.limits:
+            return
+
+        limit = self.limits.get(model_name)
+        if limit is None:
+            limit = self.limits.get(self.get_provider(model_name))
+        return limit
+
+    def reserve(self, model_name, tokens):
+        """Reserve capacity for a request, returning the seconds to wait before sending it."""
+        # Looked up outside the lock, litellm may have to be imported first
+        limit = self.get_limit(model_name)
+        if limit is None:
+            return 0
+        with self.lock:
+            return limit.reserve(tokens)
+
+    def acquire(self, model_name, tokens):
+        wait = self.reserve(model_name, tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, model_name, tokens):
+        wait = self.reserve(model_name, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def settle(self, model_name, tokens):
+        """Charge tokens which weren't reserved up front, or refund over-estimates if < 0."""
+        limit = self.get_limit(model_name)
+        if limit and limit.tokens:
+            with self.lock:
+                limit.tokens.adjust(tokens)
+
+    def is_limited(self, model_name):
+        return self.get_limit(model_name) is not None
+
+    def stats(self):
+        with self.lock:
+            return [limit.stats() for limit in self.limits.values()]
+
+
+RATE_LIMITER = RateLimiter()
+
+
+def parse_rate_limit(spec):
+    """Parse "KEY=RPM:TPM" into (key, rpm, tpm), either limit may be left empty."""
+    key, sep, limits = spec.rpartition("=")
+    if not sep or not key:
+        raise ValueError(f"Invalid rate limit {spec!r}, expected KEY=RPM:TPM")
+
+    rpm, _sep, tpm = limits.partition(":")
+    try:
+        rpm = float(rpm) if rpm else None
+        tpm = float(tpm) if tpm else None
+    except ValueError:
+        raise ValueError(f"Invalid rate limit {spec!r}, expected KEY=RPM:TPM")
+
+    if not rpm and not tpm:
+        raise ValueError(f"Invalid rate limit {spec!r}, expected KEY=RPM:TPM")
+
+    return key, rpm, tpm
+
+
+def approx_token_count(messages):
+    """A tokenizer free estimate for callers which haven't counted their tokens."""
+    chars = 0
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict):
+                    chars += len(part.get("text") or "")
+    return chars // 4
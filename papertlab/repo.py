@@ -6,6 +6,7 @@ import git
 import pathspec
 
 from papertlab import prompts, utils
+from papertlab.hedge import distinct_models, hedged_send_sync
 from papertlab.sendchat import simple_send_with_retries
 
 from .dump import dump  # noqa: F401
@@ -35,10 +36,12 @@ class GitRepo:
         attribute_commit_message_author=False,
         attribute_commit_message_committer=False,
         commit_prompt=None,
+        hedge_after=None,
     ):
         self.io = io
 
         self.models = models
+        self.hedge_after = hedge_after
 
         self.normalized_path = {}
         self.tree_files = {}
@@ -220,17 +223,25 @@ class GitRepo:
             dict(role="user", content=content),
         ]
 
-        commit_message = None
+        models = []
         for model in self.models:
             num_tokens = model.token_count(messages)
             max_tokens = model.info.get("max_input_tokens") or 0
             if max_tokens and num_tokens > max_tokens:
                 continue
-            commit_message = simple_send_with_retries(
-                model.name, messages, extra_headers=model.extra_headers
-            )
-            if commit_message:
-                break
+            models.append(model)
+
+        commit_message = None
+        hedge_models = distinct_models(models)
+        if self.hedge_after is not None and len(hedge_models) > 1:
+            _model, commit_message = hedged_send_sync(hedge_models, messages, self.hedge_after)
+        else:
+            for model in models:
+                commit_message = simple_send_with_retries(
+                    model.name, messages, extra_headers=model.extra_headers
+                )
+                if commit_message:
+                    break
 
         if not commit_message:
             self.io.tool_error("Failed to generate commit message!")
@@ -1,23 +1,31 @@
 import colorsys
+import hashlib
 import math
+import multiprocessing
 import os
 import random
 import sqlite3
 import sys
+import threading
 import time
 import warnings
-from collections import Counter, defaultdict, namedtuple
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from importlib import resources
+from itertools import chain
 from pathlib import Path
 
-from diskcache import Cache
 from grep_ast import TreeContext, filename_to_lang
 from pygments.lexers import guess_lexer_for_filename
 from pygments.token import Token
 from tqdm import tqdm
 
 from papertlab.dump import dump
+from papertlab.lru import LRUCache
 from papertlab.special import filter_important_files
+from papertlab.tagstore import Tag, TagStore, content_hash
 from papertlab.utils import Spinner
 
 # tree_sitter is throwing a FutureWarning
@@ -25,15 +33,25 @@ warnings.simplefilter("ignore", category=FutureWarning)
 from tree_sitter_languages import get_language, get_parser  # noqa: E402
 
 
-Tag = namedtuple("Tag", "rel_fname fname line name kind".split())
+# Per-process registry of each language's parser and compiled tags query, see get_tags_query()
+LANGUAGE_CACHE = dict()
+QUERY_STATS = Counter()
 
 
 class RepoMap:
-    CACHE_VERSION = 3
+    CACHE_VERSION = 4
     TAGS_CACHE_DIR = f".papertlab.tags.cache.v{CACHE_VERSION}"
 
     warned_files = set()
 
+    # Don't pay the process pool startup cost for a handful of cache misses
+    parallel_scan_threshold = 32
+    parallel_scan_batch_size = 64
+
+    # Limits for each of the in-memory map, tree and tree context caches
+    cache_max_entries = 1024
+    cache_max_mb = 64
+
     def __init__(
         self,
         map_tokens=1024,
@@ -45,10 +63,20 @@ class RepoMap:
         max_context_window=None,
         map_mul_no_files=8,
         refresh="auto",
+        map_workers=None,
+        rank_backend="sparse",
+        tags_cache_dir=None,
+        cache_max_entries=None,
+        cache_max_mb=None,
     ):
         self.io = io
         self.verbose = verbose
         self.refresh = refresh
+        self.tags_cache_dir = tags_cache_dir
+
+        if map_workers is None:
+            map_workers = os.cpu_count() or 1
+        self.map_workers = map_workers
 
         if not root:
             root = os.getcwd()
@@ -65,17 +93,71 @@ class RepoMap:
 
         self.main_model = main_model
 
-        self.tree_cache = {}
-        self.tree_context_cache = {}
-        self.map_cache = {}
+        if cache_max_entries is None:
+            cache_max_entries = self.cache_max_entries
+        if cache_max_mb is None:
+            cache_max_mb = self.cache_max_mb
+        cache_max_bytes = int(cache_max_mb * 1024 * 1024)
+
+        self.tree_cache = LRUCache(cache_max_entries, cache_max_bytes, name="tree_cache")
+        self.tree_context_cache = LRUCache(
+            cache_max_entries,
+            cache_max_bytes,
+            sizeof=lambda entry: entry["size"],
+            name="tree_context_cache",
+        )
+        self.map_cache = LRUCache(
+            cache_max_entries,
+            cache_max_bytes,
+            sizeof=lambda repo_map: len(repo_map or ""),
+            name="map_cache",
+        )
+        # Token counts are tiny, but each map's search probes many segments per file
+        self.segment_cache = LRUCache(cache_max_entries * 16, name="segment_cache")
         self.map_processing_time = 0
         self.last_map = None
 
+        # Persistent symbol graph, updated per file as their mtimes change
+        self.rank_backend = rank_backend
+        self.graph_mtimes = dict()
+        self.graph_references_fallback = False
+        self.node_ids = dict()
+        self.node_names = []
+        self.file_defines = dict()
+        self.file_references = dict()
+        self.defines = defaultdict(set)
+        self.references = defaultdict(Counter)
+        self.definitions = defaultdict(set)
+        self.ident_edges = dict()
+        self.edge_arrays = None
+        self.last_ranked = None
+        self.lock = threading.RLock()
+        self.watched_fnames = []
+        self.watcher = None
+
+        # Per thread, so a map built quietly in the background doesn't silence the others
+        self.local = threading.local()
+
+        # Tags query compiles and reuses, including those in the scan worker processes
+        self.query_stats = Counter()
+
         if self.verbose:
             self.io.tool_output(
                 f"RepoMap initialized with map_mul_no_files: {self.map_mul_no_files}"
             )
 
+    @contextmanager
+    def quietly(self):
+        """Build maps in this thread without any spinner, progress bar or messages."""
+        self.local.quiet = True
+        try:
+            yield
+        finally:
+            self.local.quiet = False
+
+    def is_quiet(self):
+        return getattr(self.local, "quiet", False)
+
     def token_count(self, text):
         len_text = len(text)
         if len_text < 200:
@@ -131,7 +213,8 @@ class RepoMap:
                 force_refresh,
             )
         except RecursionError:
-            self.io.tool_error("Disabling repo map, git repo too large?")
+            if not self.is_quiet():
+                self.io.tool_error("Disabling repo map, git repo too large?")
             self.max_map_tokens = 0
             return
 
@@ -164,12 +247,15 @@ class RepoMap:
         return [path + ":"]
 
     def load_tags_cache(self):
-        path = Path(self.root) / self.TAGS_CACHE_DIR
+        if self.tags_cache_dir:
+            path = Path(self.tags_cache_dir).expanduser()
+        else:
+            path = Path(self.root) / self.TAGS_CACHE_DIR
         try:
-            self.TAGS_CACHE = Cache(path)
-        except sqlite3.OperationalError:
+            self.TAGS_CACHE = TagStore(path, root=self.root)
+        except (sqlite3.Error, OSError):
             self.io.tool_error(f"Unable to use tags cache, delete {path} to resolve.")
-            self.TAGS_CACHE = dict()
+            self.TAGS_CACHE = TagStore(root=self.root)
 
     def save_tags_cache(self):
         pass
@@ -178,137 +264,534 @@ class RepoMap:
         try:
             return os.path.getmtime(fname)
         except FileNotFoundError:
-            self.io.tool_error(f"File not found error: {fname}")
+            if not self.is_quiet():
+                self.io.tool_error(f"File not found error: {fname}")
 
     def get_tags(self, fname, rel_fname):
-        # Check if the file is in the cache and if the modification time has not changed
         file_mtime = self.get_mtime(fname)
         if file_mtime is None:
             return []
 
-        cache_key = fname
-        if cache_key in self.TAGS_CACHE and self.TAGS_CACHE[cache_key]["mtime"] == file_mtime:
-            return self.TAGS_CACHE[cache_key]["data"]
+        tags = self.get_tags_many([(fname, rel_fname, file_mtime)])
+        return tags.get(fname, [])
 
-        # miss!
+    def get_tags_raw(self, fname, rel_fname):
+        # Not through the io's content cache, which is meant for the chat files
+        return extract_tags(fname, rel_fname, self.io.read_text_uncached)
+
+    def get_tags_many(self, files, showing_bar=False):
+        """Return a dict of fname to Tags for a list of (fname, rel_fname, mtime).
+
+        Tags are looked up by content hash. A file whose mtime and size match what
+        TAGS_CACHE last saw keeps its stored hash without being read, otherwise it is
+        rehashed. Only contents never seen before, in any checkout sharing the cache,
+        are parsed.
+        """
+        stored = self.TAGS_CACHE.get_file_hashes(fname for fname, _rel, _mtime in files)
+
+        hashes = dict()
+        rehashed = dict()
+        unreadable = dict()
+        for fname, rel_fname, file_mtime in files:
+            try:
+                size = os.path.getsize(fname)
+            except OSError:
+                size = None
+
+            cached = stored.get(fname)
+            if cached and cached[0] == file_mtime and cached[1] == size:
+                hashes[fname] = (rel_fname, cached[2])
+                continue
 
-        data = list(self.get_tags_raw(fname, rel_fname))
+            try:
+                data = Path(fname).read_bytes()
+            except OSError:
+                unreadable[fname] = []
+                continue
 
-        # Update the cache
-        self.TAGS_CACHE[cache_key] = {"mtime": file_mtime, "data": data}
-        self.save_tags_cache()
-        return data
+            file_hash = content_hash(data, filename_to_lang(fname))
+            hashes[fname] = (rel_fname, file_hash)
+            rehashed[fname] = (file_mtime, size, file_hash)
 
-    def get_tags_raw(self, fname, rel_fname):
-        lang = filename_to_lang(fname)
-        if not lang:
-            return
+        res = self.TAGS_CACHE.get_tags_many(hashes)
 
-        try:
-            language = get_language(lang)
-            parser = get_parser(lang)
-        except Exception as err:
-            print(f"Skipping file {fname}: {err}")
-            return
+        # Remember the new mtime of files whose contents were already known
+        self.TAGS_CACHE.set_files_many(
+            (fname, file_mtime, size, file_hash)
+            for fname, (file_mtime, size, file_hash) in rehashed.items()
+            if fname in res
+        )
 
-        query_scm = get_scm_fname(lang)
-        if not query_scm.exists():
-            return
-        query_scm = query_scm.read_text()
+        misses = [
+            (fname, rel_fname, rehashed[fname][0], rehashed[fname][1])
+            for fname, (rel_fname, _hash) in hashes.items()
+            if fname not in res
+        ]
+        if misses:
+            res.update(self.extract_tags_many(misses, showing_bar))
 
-        code = self.io.read_text(fname)
-        if not code:
-            return
-        tree = parser.parse(bytes(code, "utf-8"))
+        res.update(unreadable)
+        return res
 
-        # Run the tags queries
-        query = language.query(query_scm)
-        captures = query.captures(tree.root_node)
+    def extract_tags_many(self, misses, showing_bar=False):
+        """Extract the tags of a list of (fname, rel_fname, mtime, size) and store them.
 
-        captures = list(captures)
+        Uses a process pool when there are enough files to pay for its startup.
+        """
+        stats = dict((fname, (file_mtime, size)) for fname, _rel, file_mtime, size in misses)
+        batch_size = self.parallel_scan_batch_size
+        batches = [
+            [(fname, rel_fname) for fname, rel_fname, _mtime, _size in misses[i : i + batch_size]]
+            for i in range(0, len(misses), batch_size)
+        ]
 
-        saw = set()
-        for node, tag in captures:
-            if tag.startswith("name.definition."):
-                kind = "def"
-            elif tag.startswith("name.reference."):
-                kind = "ref"
-            else:
-                continue
+        if showing_bar:
+            bar = tqdm(total=len(misses), desc="Scanning repo")
+        else:
+            bar = None
 
-            saw.add(kind)
+        res = dict()
 
-            result = Tag(
-                rel_fname=rel_fname,
-                fname=fname,
-                name=node.text.decode("utf-8"),
-                kind=kind,
-                line=node.start_point[0],
+        def store(batch_result):
+            results, query_stats = batch_result
+            self.query_stats.update(query_stats)
+            self.TAGS_CACHE.set_tags_many(
+                (fname, *stats[fname], file_hash, tags)
+                for fname, file_hash, tags in results
+                if file_hash
             )
+            for fname, _file_hash, tags in results:
+                res[fname] = tags
+            if bar:
+                bar.update(len(results))
 
-            yield result
+        try:
+            if self.map_workers > 1 and len(misses) >= self.parallel_scan_threshold:
+                try:
+                    self.extract_tags_parallel(batches, store)
+                except Exception as err:
+                    if self.verbose and not self.is_quiet():
+                        self.io.tool_error(
+                            f"Parallel repo scan failed, falling back to serial: {err}"
+                        )
+
+            # Anything the pool didn't handle is extracted in this process
+            for batch in batches:
+                batch = [(fname, rel_fname) for fname, rel_fname in batch if fname not in res]
+                if batch:
+                    store(extract_tags_batch(batch, self.io.encoding))
+        finally:
+            if bar:
+                bar.close()
+
+        if self.verbose and not self.is_quiet():
+            self.show_query_stats()
+
+        return res
 
-        if "ref" in saw:
+    def show_query_stats(self):
+        reuses = self.query_stats["reuses"]
+        if not reuses:
             return
-        if "def" not in saw:
+
+        compiles = self.query_stats["compiles"]
+        compile_time = self.query_stats["compile_time"]
+
+        # Queries compiled before this RepoMap existed still give the average cost
+        stats = self.query_stats if compiles else QUERY_STATS
+        if not stats["compiles"]:
             return
+        saved = reuses * stats["compile_time"] / stats["compiles"]
 
-        # We saw defs, without any refs
-        # Some tags files only provide defs (cpp, for example)
-        # Use pygments to backfill refs
+        self.io.tool_output(
+            f"Tags queries: compiled {compiles} in {compile_time:.2f}s, reused {reuses} times,"
+            f" saving about {saved:.2f}s"
+        )
 
-        try:
-            lexer = guess_lexer_for_filename(fname, code)
-        except Exception:
+    def extract_tags_parallel(self, batches, store):
+        num_workers = min(self.map_workers, len(batches))
+        with ProcessPoolExecutor(
+            max_workers=num_workers, mp_context=get_pool_context()
+        ) as executor:
+            futures = [
+                executor.submit(extract_tags_batch, batch, self.io.encoding) for batch in batches
+            ]
+            for future in as_completed(futures):
+                # A failed batch is left for the serial pass to retry
+                try:
+                    batch_result = future.result()
+                except Exception:
+                    continue
+                store(batch_result)
+
+    def update_graph_files(self, changed, showing_bar=False):
+        """Reload the symbols of a list of changed (fname, rel_fname, mtime).
+
+        Returns the set of idents whose edges need rebuilding.
+        """
+        dirty_idents = set()
+        if not changed:
+            return dirty_idents
+
+        tags_by_fname = self.get_tags_many(changed, showing_bar)
+        for fname, rel_fname, file_mtime in changed:
+            self.update_file_symbols(rel_fname, tags_by_fname.get(fname, []), dirty_idents)
+            self.graph_mtimes[rel_fname] = file_mtime
+
+        return dirty_idents
+
+    def update_graph_edges(self, dirty_idents, progress=None):
+        references = self.references
+        references_fallback = not references
+        if references_fallback:
+            references = dict((k, Counter(v)) for k, v in self.defines.items())
+
+        if references_fallback != self.graph_references_fallback:
+            dirty_idents.update(self.ident_edges)
+            dirty_idents.update(self.defines)
+            self.graph_references_fallback = references_fallback
+
+        for ident in dirty_idents:
+            if progress:
+                progress()
+
+            self.update_ident_edges(ident, references)
+
+        if dirty_idents:
+            self.edge_arrays = None
+
+    def refresh_files(self, fnames):
+        """Bring the tags and symbol graph of fnames up to date, for the map watcher.
+
+        Files which are not in the graph yet only have their tags cached, ready for the
+        next get_ranked_tags(). Returns the number of files that were reloaded.
+        """
+        with self.lock:
+            changed = []
+            uncached = []
+            for fname in fnames:
+                try:
+                    file_mtime = os.path.getmtime(fname)
+                except OSError:
+                    continue
+
+                rel_fname = self.get_rel_fname(fname)
+                if rel_fname not in self.graph_mtimes:
+                    uncached.append((fname, rel_fname, file_mtime))
+                elif self.graph_mtimes[rel_fname] != file_mtime:
+                    changed.append((fname, rel_fname, file_mtime))
+
+            if uncached:
+                self.get_tags_many(uncached)
+
+            dirty_idents = self.update_graph_files(changed)
+            self.update_graph_edges(dirty_idents)
+            return len(changed) + len(uncached)
+
+    def start_watcher(self, fnames=None):
+        """Refresh the tags of the files in the map from a background thread as they change.
+
+        fnames seeds the files to watch until the first map is built, their tags are
+        cached right away.
+        """
+        from papertlab.watch import RepoMapWatcher
+
+        if fnames:
+            self.watched_fnames = sorted(fnames)
+
+        self.watcher = RepoMapWatcher(self, io=self.io, verbose=self.verbose)
+        self.watcher.start()
+        if fnames:
+            self.watcher.refresh_all()
+
+    def update_file_symbols(self, rel_fname, tags, dirty_idents):
+        """Replace the defines/references a file contributes to the symbol graph."""
+        old_defines = self.file_defines.pop(rel_fname, set())
+        old_references = self.file_references.pop(rel_fname, Counter())
+
+        for ident in old_defines:
+            definers = self.defines[ident]
+            definers.discard(rel_fname)
+            if not definers:
+                del self.defines[ident]
+            self.definitions.pop((rel_fname, ident), None)
+
+        for ident in old_references:
+            referencers = self.references[ident]
+            del referencers[rel_fname]
+            if not referencers:
+                del self.references[ident]
+
+        dirty_idents.update(old_defines)
+        dirty_idents.update(old_references)
+
+        if tags is None:
             return
 
-        tokens = list(lexer.get_tokens(code))
-        tokens = [token[1] for token in tokens if token[0] in Token.Name]
+        new_defines = set()
+        new_references = Counter()
+        for tag in tags:
+            if tag.kind == "def":
+                self.defines[tag.name].add(rel_fname)
+                key = (rel_fname, tag.name)
+                self.definitions[key].add(tag)
+                new_defines.add(tag.name)
+
+            elif tag.kind == "ref":
+                self.references[tag.name][rel_fname] += 1
+                new_references[tag.name] += 1
+
+        self.file_defines[rel_fname] = new_defines
+        self.file_references[rel_fname] = new_references
+
+        dirty_idents.update(new_defines)
+        dirty_idents.update(new_references)
+
+    def get_node_id(self, rel_fname):
+        node_id = self.node_ids.get(rel_fname)
+        if node_id is None:
+            node_id = len(self.node_names)
+            self.node_ids[rel_fname] = node_id
+            self.node_names.append(rel_fname)
+        return node_id
+
+    def update_ident_edges(self, ident, references):
+        """Recompute the (referencer, definer, weight) edges of a single identifier.
+
+        Weights are stored without the mention/privacy multiplier, which is applied
+        at ranking time.
+        """
+        self.ident_edges.pop(ident, None)
+
+        definers = self.defines.get(ident)
+        referencers = references.get(ident)
+        if not definers or not referencers:
+            return
 
-        for token in tokens:
-            yield Tag(
-                rel_fname=rel_fname,
-                fname=fname,
-                name=token,
-                kind="ref",
-                line=-1,
-            )
+        srcs = []
+        dsts = []
+        weights = []
+        for referencer, num_refs in referencers.items():
+            for definer in definers:
+                # dump(referencer, definer, num_refs)
+                # if referencer == definer:
+                #    continue
+
+                # scale down so high freq (low value) mentions don't dominate
+                num_refs = math.sqrt(num_refs)
+
+                srcs.append(self.get_node_id(referencer))
+                dsts.append(self.get_node_id(definer))
+                weights.append(num_refs)
+
+        self.ident_edges[ident] = (srcs, dsts, weights)
+
+    def get_ident_mul(self, ident, mentioned_idents):
+        if ident in mentioned_idents:
+            return 10
+        elif ident.startswith("_"):
+            return 0.1
+        return 1
+
+    def get_nstart(self, nodes):
+        # Warm start from the previous rank vector, most of it is still valid
+        if not self.last_ranked or not nodes:
+            return
+        default_rank = 1 / len(nodes)
+        return [self.last_ranked.get(node, default_rank) for node in nodes]
+
+    def rank_graph(self, personalization, mentioned_idents, progress=None):
+        """Run PageRank over the symbol graph.
+
+        Returns the rank of each file and the rank flowing into each (definer, ident).
+        Raises ZeroDivisionError if none of the personalized files are in the graph.
+        """
+        if self.rank_backend == "sparse":
+            try:
+                return self.rank_graph_sparse(personalization, mentioned_idents, progress)
+            except ImportError:
+                self.rank_backend = "networkx"
+
+        return self.rank_graph_networkx(personalization, mentioned_idents, progress)
+
+    def build_edge_arrays(self):
+        import numpy as np
+
+        idents = list(self.ident_edges)
+        ident_pos = dict((ident, pos) for pos, ident in enumerate(idents))
+        private = np.array([ident.startswith("_") for ident in idents], dtype=bool)
+
+        counts = [len(self.ident_edges[ident][0]) for ident in idents]
+        num_edges = sum(counts)
+
+        def column(col, dtype):
+            values = chain.from_iterable(self.ident_edges[ident][col] for ident in idents)
+            return np.fromiter(values, dtype=dtype, count=num_edges)
+
+        src = column(0, np.int64)
+        dst = column(1, np.int64)
+        weight = column(2, np.float64)
+        ident_idx = np.repeat(np.arange(len(idents), dtype=np.int64), counts)
+
+        return dict(
+            src=src,
+            dst=dst,
+            weight=weight,
+            ident_idx=ident_idx,
+            idents=idents,
+            ident_pos=ident_pos,
+            private=private,
+        )
+
+    def rank_graph_sparse(self, personalization, mentioned_idents, progress=None):
+        import numpy as np
+
+        if self.edge_arrays is None:
+            self.edge_arrays = self.build_edge_arrays()
+        edges = self.edge_arrays
+
+        if progress:
+            progress()
+
+        idents = edges["idents"]
+        num_idents = len(idents)
+
+        mul = np.where(edges["private"], 0.1, 1.0)
+        for ident in mentioned_idents:
+            pos = edges["ident_pos"].get(ident)
+            if pos is not None:
+                mul[pos] = 10
+        weight = mul[edges["ident_idx"]] * edges["weight"]
+
+        # Compact the global node ids down to the nodes which have edges
+        node_ids = np.unique(np.concatenate([edges["src"], edges["dst"]]))
+        num_nodes = len(node_ids)
+        if not num_nodes:
+            return dict(), dict()
+
+        src = np.searchsorted(node_ids, edges["src"])
+        dst = np.searchsorted(node_ids, edges["dst"])
+        nodes = [self.node_names[node_id] for node_id in node_ids]
+
+        if personalization:
+            pers = np.array([personalization.get(node, 0) for node in nodes], dtype=float)
+        else:
+            pers = None
+
+        nstart = self.get_nstart(nodes)
+
+        x = sparse_pagerank(
+            num_nodes,
+            src,
+            dst,
+            weight,
+            personalization=pers,
+            dangling=pers,
+            nstart=nstart,
+        )
+
+        if progress:
+            progress()
+
+        ranked = dict(zip(nodes, x.tolist()))
+
+        # distribute the rank from each source node, across all of its out edges
+        out_weight = np.bincount(src, weights=weight, minlength=num_nodes)
+        edge_rank = x[src] * weight / out_weight[src]
+
+        pairs, inverse = np.unique(dst * num_idents + edges["ident_idx"], return_inverse=True)
+        pair_ranks = np.bincount(inverse, weights=edge_rank)
+
+        ranked_definitions = dict()
+        for pair, rank in zip(pairs.tolist(), pair_ranks.tolist()):
+            node, pos = divmod(pair, num_idents)
+            ranked_definitions[(nodes[node], idents[pos])] = rank
+
+        return ranked, ranked_definitions
+
+    def rank_graph_networkx(self, personalization, mentioned_idents, progress=None):
+        import networkx as nx
+
+        G = nx.MultiDiGraph()
+        for ident, (srcs, dsts, weights) in self.ident_edges.items():
+            if progress:
+                progress()
+
+            mul = self.get_ident_mul(ident, mentioned_idents)
+            for src, dst, weight in zip(srcs, dsts, weights):
+                G.add_edge(
+                    self.node_names[src], self.node_names[dst], weight=mul * weight, ident=ident
+                )
+
+        if personalization:
+            pers_args = dict(personalization=personalization, dangling=personalization)
+        else:
+            pers_args = dict()
+
+        nstart = self.get_nstart(list(G.nodes))
+        if nstart:
+            nstart = dict(zip(G.nodes, nstart))
+
+        ranked = nx.pagerank(G, weight="weight", nstart=nstart, **pers_args)
+
+        # distribute the rank from each source node, across all of its out edges
+        ranked_definitions = defaultdict(float)
+        for src in G.nodes:
+            if progress:
+                progress()
+
+            src_rank = ranked[src]
+            total_weight = sum(data["weight"] for _src, _dst, data in G.out_edges(src, data=True))
+            # dump(src, src_rank, total_weight)
+            for _src, dst, data in G.out_edges(src, data=True):
+                rank = src_rank * data["weight"] / total_weight
+                ident = data["ident"]
+                ranked_definitions[(dst, ident)] += rank
+
+        return ranked, ranked_definitions
 
     def get_ranked_tags(
         self, chat_fnames, other_fnames, mentioned_fnames, mentioned_idents, progress=None
     ):
-        import networkx as nx
-
-        defines = defaultdict(set)
-        references = defaultdict(list)
-        definitions = defaultdict(set)
+        # The map watcher updates the symbol graph from its own thread
+        with self.lock:
+            return self.get_ranked_tags_unlocked(
+                chat_fnames, other_fnames, mentioned_fnames, mentioned_idents, progress
+            )
 
+    def get_ranked_tags_unlocked(
+        self, chat_fnames, other_fnames, mentioned_fnames, mentioned_idents, progress=None
+    ):
         personalization = dict()
 
         fnames = set(chat_fnames).union(set(other_fnames))
         chat_rel_fnames = set()
 
         fnames = sorted(fnames)
+        self.watched_fnames = fnames
 
         # Default personalization for unspecified files is 1/num_nodes
         # https://networkx.org/documentation/stable/_modules/networkx/algorithms/link_analysis/pagerank_alg.html#pagerank
         personalize = 100 / len(fnames)
 
-        if len(fnames) - len(self.TAGS_CACHE) > 100:
+        if len(fnames) - len(self.TAGS_CACHE) > 100 and not self.is_quiet():
             self.io.tool_output(
                 "Initial repo scan can be slow in larger repos, but only happens once."
             )
-            fnames = tqdm(fnames, desc="Scanning repo")
             showing_bar = True
         else:
             showing_bar = False
 
+        # Only files which changed since the last call contribute new symbols
+        changed = []
+        seen_rel_fnames = set()
+
         for fname in fnames:
-            if progress and not showing_bar:
+            if progress:
                 progress()
 
             if not Path(fname).is_file():
-                if fname not in self.warned_files:
+                if fname not in self.warned_files and not self.is_quiet():
                     if Path(fname).exists():
                         self.io.tool_error(
                             f"Repo-map can't include {fname}, it is not a normal file"
@@ -316,11 +799,12 @@ class RepoMap:
                     else:
                         self.io.tool_error(f"Repo-map can't include {fname}, it no longer exists")
 
-                self.warned_files.add(fname)
+                    self.warned_files.add(fname)
                 continue
 
             # dump(fname)
             rel_fname = self.get_rel_fname(fname)
+            seen_rel_fnames.add(rel_fname)
 
             if fname in chat_fnames:
                 personalization[rel_fname] = personalize
@@ -329,80 +813,34 @@ class RepoMap:
             if rel_fname in mentioned_fnames:
                 personalization[rel_fname] = personalize
 
-            tags = list(self.get_tags(fname, rel_fname))
-            if tags is None:
+            file_mtime = self.get_mtime(fname)
+            if rel_fname in self.graph_mtimes and self.graph_mtimes[rel_fname] == file_mtime:
                 continue
 
-            for tag in tags:
-                if tag.kind == "def":
-                    defines[tag.name].add(rel_fname)
-                    key = (rel_fname, tag.name)
-                    definitions[key].add(tag)
+            changed.append((fname, rel_fname, file_mtime))
+
+        dirty_idents = self.update_graph_files(changed, showing_bar)
 
-                elif tag.kind == "ref":
-                    references[tag.name].append(rel_fname)
+        # Drop files which are gone, or no longer part of the map
+        for rel_fname in set(self.graph_mtimes) - seen_rel_fnames:
+            self.update_file_symbols(rel_fname, None, dirty_idents)
+            del self.graph_mtimes[rel_fname]
 
         ##
-        # dump(defines)
-        # dump(references)
+        # dump(self.defines)
+        # dump(self.references)
         # dump(personalization)
 
-        if not references:
-            references = dict((k, list(v)) for k, v in defines.items())
-
-        idents = set(defines.keys()).intersection(set(references.keys()))
-
-        G = nx.MultiDiGraph()
-
-        for ident in idents:
-            if progress:
-                progress()
-
-            definers = defines[ident]
-            if ident in mentioned_idents:
-                mul = 10
-            elif ident.startswith("_"):
-                mul = 0.1
-            else:
-                mul = 1
-
-            for referencer, num_refs in Counter(references[ident]).items():
-                for definer in definers:
-                    # dump(referencer, definer, num_refs, mul)
-                    # if referencer == definer:
-                    #    continue
-
-                    # scale down so high freq (low value) mentions don't dominate
-                    num_refs = math.sqrt(num_refs)
-
-                    G.add_edge(referencer, definer, weight=mul * num_refs, ident=ident)
-
-        if not references:
-            pass
-
-        if personalization:
-            pers_args = dict(personalization=personalization, dangling=personalization)
-        else:
-            pers_args = dict()
+        self.update_graph_edges(dirty_idents, progress)
 
         try:
-            ranked = nx.pagerank(G, weight="weight", **pers_args)
+            ranked, ranked_definitions = self.rank_graph(
+                personalization, mentioned_idents, progress
+            )
         except ZeroDivisionError:
             return []
 
-        # distribute the rank from each source node, across all of its out edges
-        ranked_definitions = defaultdict(float)
-        for src in G.nodes:
-            if progress:
-                progress()
-
-            src_rank = ranked[src]
-            total_weight = sum(data["weight"] for _src, _dst, data in G.out_edges(src, data=True))
-            # dump(src, src_rank, total_weight)
-            for _src, dst, data in G.out_edges(src, data=True):
-                data["rank"] = src_rank * data["weight"] / total_weight
-                ident = data["ident"]
-                ranked_definitions[(dst, ident)] += data["rank"]
+        self.last_ranked = ranked
 
         ranked_tags = []
         ranked_definitions = sorted(ranked_definitions.items(), reverse=True, key=lambda x: x[1])
@@ -413,7 +851,7 @@ class RepoMap:
             # print(f"{rank:.03f} {fname} {ident}")
             if fname in chat_rel_fnames:
                 continue
-            ranked_tags += list(definitions.get((fname, ident), []))
+            ranked_tags += list(self.definitions.get((fname, ident), []))
 
         rel_other_fnames_without_tags = set(self.get_rel_fname(fname) for fname in other_fnames)
 
@@ -431,6 +869,12 @@ class RepoMap:
 
         return ranked_tags
 
+    def uses_cached_map(self):
+        """Whether get_ranked_tags_map() will reuse a cached map, whatever is mentioned."""
+        if self.refresh in ("files", "manual"):
+            return True
+        return self.refresh == "auto" and self.map_processing_time > 1.0
+
     def get_ranked_tags_map(
         self,
         chat_fnames,
@@ -442,8 +886,8 @@ class RepoMap:
     ):
         # Create a cache key
         cache_key = (
-            tuple(sorted(chat_fnames)) if chat_fnames else None,
-            tuple(sorted(other_fnames)) if other_fnames else None,
+            fingerprint_fnames(chat_fnames),
+            fingerprint_fnames(other_fnames),
             max_map_tokens,
         )
 
@@ -459,8 +903,11 @@ class RepoMap:
                 use_cache = self.map_processing_time > 1.0
 
             # Check if the result is in the cache
-            if use_cache and cache_key in self.map_cache:
-                return self.map_cache[cache_key]
+            if use_cache:
+                result = self.map_cache.get(cache_key, self.map_cache)
+                if result is not self.map_cache:
+                    self.show_cache_stats()
+                    return result
 
         # If not in cache or force_refresh is True, generate the map
         start_time = time.time()
@@ -473,9 +920,22 @@ class RepoMap:
         # Store the result in the cache
         self.map_cache[cache_key] = result
         self.last_map = result
+        self.show_cache_stats()
 
         return result
 
+    def show_cache_stats(self):
+        if not self.verbose or self.is_quiet():
+            return
+
+        for cache in (
+            self.map_cache,
+            self.tree_cache,
+            self.tree_context_cache,
+            self.segment_cache,
+        ):
+            self.io.tool_output(cache.stats())
+
     def get_ranked_tags_map_uncached(
         self,
         chat_fnames,
@@ -493,7 +953,7 @@ class RepoMap:
         if not mentioned_idents:
             mentioned_idents = set()
 
-        spin = Spinner("Updating repo map")
+        spin = Spinner("Updating repo map", quiet=self.is_quiet())
 
         ranked_tags = self.get_ranked_tags(
             chat_fnames,
@@ -514,26 +974,27 @@ class RepoMap:
         num_tags = len(ranked_tags)
         lower_bound = 0
         upper_bound = num_tags
-        best_tree = None
+        best_middle = None
         best_tree_tokens = 0
 
         chat_rel_fnames = set(self.get_rel_fname(fname) for fname in chat_fnames)
 
-        self.tree_cache = dict()
+        # Probes add up the cached token counts of each file's segment, instead of
+        # rendering and tokenizing the whole prefix every time
+        file_entries = self.index_ranked_tags(ranked_tags, chat_rel_fnames)
 
         middle = min(max_map_tokens // 25, num_tags)
         while lower_bound <= upper_bound:
 
             spin.step()
 
-            tree = self.to_tree(ranked_tags[:middle], chat_rel_fnames)
-            num_tokens = self.token_count(tree)
+            num_tokens = self.prefix_token_count(file_entries, middle)
 
             pct_err = abs(num_tokens - max_map_tokens) / max_map_tokens
             ok_err = 0.15
 
             if (num_tokens <= max_map_tokens and num_tokens > best_tree_tokens) or pct_err < ok_err:
-                best_tree = tree
+                best_middle = middle
                 best_tree_tokens = num_tokens
 
                 if pct_err < ok_err:
@@ -546,22 +1007,88 @@ class RepoMap:
 
             middle = (lower_bound + upper_bound) // 2
 
+        best_tree = None
+        if best_middle is not None:
+            best_tree = self.to_tree(ranked_tags[:best_middle], chat_rel_fnames)
+
         spin.end()
         return best_tree
 
-    tree_cache = dict()
+    def index_ranked_tags(self, ranked_tags, chat_rel_fnames):
+        """Group the positions of ranked_tags by file, for prefix_token_count()."""
+        file_entries = dict()
+        for i, tag in enumerate(ranked_tags):
+            rel_fname = tag[0]
+            if rel_fname in chat_rel_fnames:
+                continue
+
+            entry = file_entries.get(rel_fname)
+            if entry is None:
+                entry = dict(abs_fname=None, mtime=None, bare_pos=None, positions=[], lines=[])
+                file_entries[rel_fname] = entry
+
+            if type(tag) is Tag:
+                if entry["abs_fname"] is None:
+                    entry["abs_fname"] = tag.fname
+                    entry["mtime"] = self.get_mtime(tag.fname)
+                entry["positions"].append(i)
+                entry["lines"].append(tag.line)
+            elif entry["bare_pos"] is None:
+                entry["bare_pos"] = i
+
+        return file_entries
+
+    def prefix_token_count(self, file_entries, num_tags):
+        """Estimate the tokens in to_tree() of the first num_tags ranked tags."""
+        total = 0
+        for rel_fname, entry in file_entries.items():
+            # Like to_tree(), a file with a bare (fname,) entry is listed without its tags
+            bare_pos = entry["bare_pos"]
+            if bare_pos is not None and bare_pos < num_tags:
+                num_lois = None
+            else:
+                num_lois = bisect_left(entry["positions"], num_tags)
+                if not num_lois:
+                    continue
+
+            total += self.segment_token_count(rel_fname, entry, num_lois)
+        return total
+
+    def segment_token_count(self, rel_fname, entry, num_lois):
+        # Keyed like tree_cache, so counts carry over to later maps until the file changes
+        if num_lois is None:
+            key = (rel_fname, None)
+        else:
+            lois = entry["lines"][:num_lois]
+            key = (rel_fname, tuple(sorted(lois)), entry["mtime"])
+
+        num_tokens = self.segment_cache.get(key)
+        if num_tokens is not None:
+            return num_tokens
+
+        if num_lois is None:
+            segment = "\n" + rel_fname + "\n"
+        else:
+            segment = "\n" + rel_fname + ":\n"
+            segment += self.render_tree(entry["abs_fname"], rel_fname, lois)
+
+        segment = "\n".join([line[:100] for line in segment.splitlines()]) + "\n"
+        num_tokens = self.token_count(segment)
+        self.segment_cache[key] = num_tokens
+        return num_tokens
 
     def render_tree(self, abs_fname, rel_fname, lois):
         mtime = self.get_mtime(abs_fname)
         key = (rel_fname, tuple(sorted(lois)), mtime)
 
-        if key in self.tree_cache:
-            return self.tree_cache[key]
-        if (
-            rel_fname not in self.tree_context_cache
-            or self.tree_context_cache[rel_fname]["mtime"] != mtime
-        ):
-            code = self.io.read_text(abs_fname) or ""
+        res = self.tree_cache.get(key)
+        if res is not None:
+            return res
+
+        entry = self.tree_context_cache.get(rel_fname)
+        if not entry or entry["mtime"] != mtime:
+            # The tree context keeps the text, so the io's content cache needn't as well
+            code = self.io.read_text_uncached(abs_fname) or ""
             if not code.endswith("\n"):
                 code += "\n"
 
@@ -578,9 +1105,11 @@ class RepoMap:
                 # header_max=30,
                 show_top_of_file_parent_scope=False,
             )
-            self.tree_context_cache[rel_fname] = {"context": context, "mtime": mtime}
+            # Sized by the file's text, the TreeContext itself is a multiple of that
+            entry = {"context": context, "mtime": mtime, "size": len(code)}
+            self.tree_context_cache[rel_fname] = entry
 
-        context = self.tree_context_cache[rel_fname]["context"]
+        context = entry["context"]
         context.lines_of_interest = set()
         context.add_lines_of_interest(lois)
         context.add_context()
@@ -627,6 +1156,217 @@ class RepoMap:
         return output
 
 
+def fingerprint_fnames(fnames):
+    """A compact cache key for a collection of file names."""
+    if not fnames:
+        return None
+
+    fnames = sorted(fnames)
+    return hashlib.sha1("\0".join(fnames).encode("utf-8", "surrogateescape")).hexdigest()
+
+
+def get_tags_query(lang):
+    """Return the (parser, query) used to extract tags from lang files.
+
+    Each language's tags query is compiled once per process, and its parser reused.
+    Returns None if papertlab has no tags query for lang.
+    """
+    entry = LANGUAGE_CACHE.get(lang, LANGUAGE_CACHE)
+    if entry is not LANGUAGE_CACHE:
+        QUERY_STATS["reuses"] += 1
+        if isinstance(entry, Exception):
+            raise entry
+        return entry
+
+    start = time.time()
+    try:
+        language = get_language(lang)
+        parser = get_parser(lang)
+    except Exception as err:
+        LANGUAGE_CACHE[lang] = err
+        raise
+
+    query_scm = get_scm_fname(lang)
+    if query_scm.exists():
+        entry = (parser, language.query(query_scm.read_text()))
+    else:
+        entry = None
+
+    QUERY_STATS["compiles"] += 1
+    QUERY_STATS["compile_time"] += time.time() - start
+    LANGUAGE_CACHE[lang] = entry
+    return entry
+
+
+def extract_tags(fname, rel_fname, read_text):
+    lang = filename_to_lang(fname)
+    if not lang:
+        return
+
+    try:
+        entry = get_tags_query(lang)
+    except Exception as err:
+        print(f"Skipping file {fname}: {err}")
+        return
+
+    if not entry:
+        return
+    parser, query = entry
+
+    code = read_text(fname)
+    if not code:
+        return
+    tree = parser.parse(bytes(code, "utf-8"))
+
+    # Run the tags queries
+    captures = query.captures(tree.root_node)
+
+    captures = list(captures)
+
+    saw = set()
+    for node, tag in captures:
+        if tag.startswith("name.definition."):
+            kind = "def"
+        elif tag.startswith("name.reference."):
+            kind = "ref"
+        else:
+            continue
+
+        saw.add(kind)
+
+        result = Tag(
+            rel_fname=rel_fname,
+            fname=fname,
+            name=node.text.decode("utf-8"),
+            kind=kind,
+            line=node.start_point[0],
+        )
+
+        yield result
+
+    if "ref" in saw:
+        return
+    if "def" not in saw:
+        return
+
+    # We saw defs, without any refs
+    # Some tags files only provide defs (cpp, for example)
+    # Use pygments to backfill refs
+
+    try:
+        lexer = guess_lexer_for_filename(fname, code)
+    except Exception:
+        return
+
+    tokens = list(lexer.get_tokens(code))
+    tokens = [token[1] for token in tokens if token[0] in Token.Name]
+
+    for token in tokens:
+        yield Tag(
+            rel_fname=rel_fname,
+            fname=fname,
+            name=token,
+            kind="ref",
+            line=-1,
+        )
+
+
+def get_pool_context():
+    # Forking while the watcher, async loop or prebuild threads hold locks could deadlock
+    # the children, so start them fresh
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def extract_tags_batch(batch, encoding):
+    """Extract the tags of a batch of (fname, rel_fname) pairs.
+
+    Runs in the process pool workers, so it reads the files itself instead of via io.
+    Returns a list of (fname, content_hash, tags), and the tags query stats of the batch.
+    """
+    stats_before = Counter(QUERY_STATS)
+    res = []
+    for fname, rel_fname in batch:
+        try:
+            data = Path(fname).read_bytes()
+        except OSError:
+            res.append((fname, None, []))
+            continue
+
+        try:
+            code = data.decode(encoding)
+        except UnicodeError:
+            code = None
+
+        tags = list(extract_tags(fname, rel_fname, lambda _fname: code))
+        res.append((fname, content_hash(data, filename_to_lang(fname)), tags))
+
+    query_stats = Counter(QUERY_STATS)
+    query_stats.subtract(stats_before)
+    return res, query_stats
+
+
+def sparse_pagerank(
+    num_nodes,
+    src,
+    dst,
+    weight,
+    personalization=None,
+    dangling=None,
+    nstart=None,
+    alpha=0.85,
+    max_iter=100,
+    tol=1.0e-6,
+):
+    """PageRank by power iteration over a CSR matrix, matching networkx's pagerank().
+
+    Parallel edges are summed. Unlike networkx, the last iterate is returned instead of
+    raising if it hasn't converged after max_iter iterations.
+    """
+    import numpy as np
+    import scipy.sparse as sp
+
+    N = num_nodes
+    if N == 0:
+        return np.zeros(0)
+
+    A = sp.csr_array((weight, (src, dst)), shape=(N, N), dtype=float)
+    S = A.sum(axis=1)
+    S[S != 0] = 1.0 / S[S != 0]
+    Q = sp.csr_array(sp.spdiags(S.T, 0, *A.shape))
+    A = Q @ A
+
+    if nstart is None:
+        x = np.repeat(1.0 / N, N)
+    else:
+        x = np.asarray(nstart, dtype=float)
+        x /= x.sum()
+
+    if personalization is None:
+        p = np.repeat(1.0 / N, N)
+    else:
+        p = np.asarray(personalization, dtype=float)
+        if p.sum() == 0:
+            raise ZeroDivisionError
+        p = p / p.sum()
+
+    if dangling is None:
+        dangling_weights = p
+    else:
+        dangling_weights = np.asarray(dangling, dtype=float)
+        dangling_weights = dangling_weights / dangling_weights.sum()
+    is_dangling = np.where(S == 0)[0]
+
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (x @ A + sum(x[is_dangling]) * dangling_weights) + (1 - alpha) * p
+        err = np.absolute(x - xlast).sum()
+        if err < N * tol:
+            break
+
+    return x
+
+
 def find_src_files(directory):
     if not os.path.isdir(directory):
         return [directory]
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+from papertlab.dump import dump  # noqa: F401
+from papertlab.llm import litellm
+
+
+def retry_exceptions():
+    import httpx
+
+    return (
+        httpx.ConnectError,
+        httpx.RemoteProtocolError,
+        httpx.ReadTimeout,
+        litellm.exceptions.APIConnectionError,
+        litellm.exceptions.APIError,
+        litellm.exceptions.RateLimitError,
+        litellm.exceptions.ServiceUnavailableError,
+        litellm.exceptions.Timeout,
+        litellm.exceptions.InternalServerError,
+        litellm.llms.anthropic.AnthropicError,
+    )
+
+
+@dataclass
+class RetryPolicy:
+    # Each wait is drawn uniformly from [0, min(max_delay, base_delay * 2**retry)]
+    base_delay: float = 0.5
+    max_delay: float = 30
+    # Budget for the total time one logical request spends retrying, from its first failure.
+    # The clock starts there, so a long response beforehand doesn't rule out retrying.
+    max_time: float = 60
+    max_attempts: Optional[int] = 10
+
+
+DEFAULT_POLICY = RetryPolicy()
+
+
+class RetryStats:
+    """Per model counts of requests, retries, time spent waiting and final outcomes."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.requests = Counter()
+            self.retries = Counter()
+            self.wait = defaultdict(float)
+            self.outcomes = defaultdict(Counter)
+
+    def record_request(self, model_name):
+        with self.lock:
+            self.requests[model_name] += 1
+
+    def record_retry(self, model_name, wait):
+        with self.lock:
+            self.retries[model_name] += 1
+            self.wait[model_name] += wait
+
+    def record_outcome(self, model_name, outcome):
+        with self.lock:
+            self.outcomes[model_name][outcome] += 1
+
+    def stats(self):
+        res = []
+        with self.lock:
+            for model_name in self.requests:
+                outcomes = ", ".join(
+                    f"{num} {outcome}" for outcome, num in sorted(self.outcomes[model_name].items())
+                )
+                res.append(
+                    f"Retries {model_name}: {self.requests[model_name]} requests,"
+                    f" {self.retries[model_name]} retries, {self.wait[model_name]:.1f}s waiting"
+                    + (f" ({outcomes})" if outcomes else "")
+                )
+        return res
+
+
+RETRY_STATS = RetryStats()
+
+
+class Retrier:
+    """Decides whether, and after how long, one logical request should be retried.
+
+    Every retry of the request draws from the same attempt and time budget, so callers
+    which retry in one place can't compound into retrying multiplicatively.
+    """
+
+    def __init__(self, model_name, policy=None, stats=RETRY_STATS):
+        self.model_name = model_name
+        self.policy = policy or DEFAULT_POLICY
+        self.stats = stats
+
+        # When the first retryable error happened
+        self.start = None
+        self.retries = 0
+        self.done = False
+
+        self.stats.record_request(model_name)
+
+    def next_wait(self, err):
+        """Seconds to wait before retrying after err, or None to give up."""
+        if not isinstance(err, retry_exceptions()):
+            self.finish("failed")
+            return
+
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+
+        policy = self.policy
+        if policy.max_attempts is not None and self.retries + 1 >= policy.max_attempts:
+            self.finish("exhausted")
+            return
+
+        wait = random.uniform(0, min(policy.max_delay, policy.base_delay * 2**self.retries))
+        if now - self.start + wait > policy.max_time:
+            self.finish("exhausted")
+            return
+
+        self.retries += 1
+        self.stats.record_retry(self.model_name, wait)
+        return wait
+
+    def finish(self, outcome):
+        if self.done:
+            return
+        self.done = True
+        self.stats.record_outcome(self.model_name, outcome)
+
+    def succeeded(self):
+        self.finish("succeeded" if not self.retries else "succeeded after retry")
+
+
+def with_retries(func):
+    """Retry func(model_name, ...) on transient errors, under the default RetryPolicy.
+
+    Works on both plain and coroutine functions.
+    """
+
+    def show_retry(err, wait):
+        print(f"{err}\nRetry in {wait:.1f} seconds.")
+
+    if asyncio.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(model_name, *args, **kwargs):
+            retrier = Retrier(model_name)
+            while True:
+                try:
+                    res = await func(model_name, *args, **kwargs)
+                except asyncio.CancelledError:
+                    # eg: the request lost a hedged race
+                    retrier.finish("cancelled")
+                    raise
+                except Exception as err:
+                    wait = retrier.next_wait(err)
+                    if wait is None:
+                        raise
+                    show_retry(err, wait)
+                    await asyncio.sleep(wait)
+                    continue
+
+                retrier.succeeded()
+                return res
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(model_name, *args, **kwargs):
+        retrier = Retrier(model_name)
+        while True:
+            try:
+                res = func(model_name, *args, **kwargs)
+            except Exception as err:
+                wait = retrier.next_wait(err)
+                if wait is None:
+                    raise
+                show_retry(err, wait)
+                time.sleep(wait)
+                continue
+
+            retrier.succeeded()
+            return res
+
+    return wrapper
@@ -1,53 +1,87 @@
 import hashlib
 import json
+import os
 
-import backoff
-
+from papertlab.asyncloop import BACKGROUND_LOOP
 from papertlab.dump import dump  # noqa: F401
 from papertlab.llm import litellm
-
-# from diskcache import Cache
-
+from papertlab.ratelimit import RATE_LIMITER, approx_token_count
+from papertlab.retry import retry_exceptions, with_retries  # noqa: F401
 
 CACHE_PATH = "~/.papertlab.send.cache.v1"
 CACHE = None
-# CACHE = Cache(CACHE_PATH)
 
-def retry_exceptions():
-    import httpx
+# The pooled httpx client of BACKGROUND_LOOP, shared by all async completions
+ASYNC_CLIENT = None
+ASYNC_MAX_CONNECTIONS = 100
+ASYNC_MAX_KEEPALIVE = 20
 
-    return (
-        httpx.ConnectError,
-        httpx.RemoteProtocolError,
-        httpx.ReadTimeout,
-        litellm.exceptions.APIConnectionError,
-        litellm.exceptions.APIError,
-        litellm.exceptions.RateLimitError,
-        litellm.exceptions.ServiceUnavailableError,
-        litellm.exceptions.Timeout,
-        litellm.exceptions.InternalServerError,
-        litellm.llms.anthropic.AnthropicError,
-    )
 
-def lazy_litellm_retry_decorator(func):
-    def wrapper(*args, **kwargs):
-        
-        decorated_func = backoff.on_exception(
-            backoff.expo,
+class CompletionCache:
+    """Opt-in on-disk cache of completions, keyed by the SHA1 of their request.
 
-            retry_exceptions(),
-            
-            max_time=60,
-            on_backoff=lambda details: print(
-                f"{details.get('exception', 'Exception')}\nRetry in {details['wait']:.1f} seconds."
-            ),
-        )(func)
-        return decorated_func(*args, **kwargs)
+    Bounded to size_limit_mb, evicting the least recently used entries, and entries
+    expire after ttl seconds (None to keep them until evicted). Streamed responses are
+    recorded chunk by chunk as they are consumed, and only stored once the stream has
+    completed; a hit replays the recorded chunks.
+    """
 
-    return wrapper
+    def __init__(self, path=CACHE_PATH, size_limit_mb=1024, ttl=None):
+        from diskcache import Cache
 
+        self.cache = Cache(
+            os.path.expanduser(path),
+            size_limit=int(size_limit_mb * 1024 * 1024),
+            eviction_policy="least-recently-used",
+        )
+        self.ttl = ttl
 
-def send_completion(
+    def get(self, key):
+        try:
+            entry = self.cache.get(key)
+        except Exception:
+            return
+
+        if not entry:
+            return
+        if entry["stream"]:
+            return iter(entry["chunks"])
+        return entry["response"]
+
+    def set(self, key, entry):
+        try:
+            self.cache.set(key, entry, expire=self.ttl)
+        except Exception:
+            # Unpicklable response, or the cache is unavailable
+            pass
+
+    def store(self, key, response):
+        self.set(key, dict(stream=False, response=response))
+
+    def record_stream(self, key, stream):
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+
+        self.set(key, dict(stream=True, chunks=chunks))
+
+    async def record_stream_async(self, key, stream):
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+
+        self.set(key, dict(stream=True, chunks=chunks))
+
+
+def enable_cache(path=CACHE_PATH, size_limit_mb=1024, ttl=None):
+    global CACHE
+    CACHE = CompletionCache(path, size_limit_mb, ttl)
+    return CACHE
+
+
+def completion_kwargs(
     model_name,
     messages,
     functions,
@@ -56,8 +90,6 @@ def send_completion(
     extra_headers=None,
     max_tokens=None,
 ):
-    from papertlab.llm import litellm
-
     kwargs = dict(
         model=model_name,
         messages=messages,
@@ -78,19 +110,157 @@ def send_completion(
     # Generate SHA1 hash of kwargs and append it to chat_completion_call_hashes
     hash_object = hashlib.sha1(key)
 
-    if not stream and CACHE is not None and key in CACHE:
-        return hash_object, CACHE[key]
+    return kwargs, hash_object
+
+
+def rate_limit_tokens(model_name, messages, tokens):
+    """The prompt tokens to reserve against model_name's rate limit, None if it has none."""
+    if not RATE_LIMITER.is_limited(model_name):
+        return
+    if tokens is None:
+        tokens = approx_token_count(messages)
+    return tokens
+
+
+def settle_rate_limit(model_name, tokens, res):
+    """Charge the completion's actual usage, in place of the estimate reserved for it."""
+    usage = getattr(res, "usage", None)
+    total_tokens = getattr(usage, "total_tokens", None)
+    if total_tokens:
+        RATE_LIMITER.settle(model_name, total_tokens - tokens)
+
+
+def send_completion(
+    model_name,
+    messages,
+    functions,
+    stream,
+    temperature=0,
+    extra_headers=None,
+    max_tokens=None,
+    tokens=None,
+):
+    from papertlab.llm import litellm
+
+    kwargs, hash_object = completion_kwargs(
+        model_name, messages, functions, stream, temperature, extra_headers, max_tokens
+    )
+
+    if CACHE is not None:
+        res = CACHE.get(hash_object.hexdigest())
+        if res is not None:
+            return hash_object, res
 
     # del kwargs['stream']
 
+    tokens = rate_limit_tokens(model_name, messages, tokens)
+    if tokens is not None:
+        RATE_LIMITER.acquire(model_name, tokens)
+
     res = litellm.completion(**kwargs)
 
-    if not stream and CACHE is not None:
-        CACHE[key] = res
+    if tokens is not None and not stream:
+        settle_rate_limit(model_name, tokens, res)
+
+    if CACHE is not None:
+        if stream:
+            res = CACHE.record_stream(hash_object.hexdigest(), res)
+        else:
+            CACHE.store(hash_object.hexdigest(), res)
+
+    return hash_object, res
+
+
+def get_async_client():
+    """The pooled httpx client, which must only be used on BACKGROUND_LOOP."""
+    global ASYNC_CLIENT
+
+    import httpx
+
+    if ASYNC_CLIENT is None:
+        limits = httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        )
+        ASYNC_CLIENT = httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(600, connect=10))
+        BACKGROUND_LOOP.on_shutdown(close_async_client)
+    return ASYNC_CLIENT
+
+
+async def close_async_client():
+    global ASYNC_CLIENT
+
+    client, ASYNC_CLIENT = ASYNC_CLIENT, None
+    if client is not None:
+        await client.aclose()
+
+
+async def replay_stream(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def async_send_completion(
+    model_name,
+    messages,
+    functions,
+    stream,
+    temperature=0,
+    extra_headers=None,
+    max_tokens=None,
+    tokens=None,
+):
+    """Like send_completion(), but awaits litellm.acompletion.
+
+    Requests all run on BACKGROUND_LOOP, sharing its pooled connections instead of holding
+    a thread each, and are handed over to it when awaited on any other loop. Streams are
+    returned as async iterators.
+    """
+    args = (model_name, messages, functions, stream, temperature, extra_headers, max_tokens)
+
+    if not BACKGROUND_LOOP.is_current():
+        hash_object, res = await BACKGROUND_LOOP.delegate(
+            async_send_completion(*args, tokens=tokens)
+        )
+        if stream:
+            res = BACKGROUND_LOOP.delegate_stream(res)
+        return hash_object, res
+
+    from papertlab.llm import litellm
+
+    kwargs, hash_object = completion_kwargs(*args)
+
+    if CACHE is not None:
+        res = CACHE.get(hash_object.hexdigest())
+        if res is not None:
+            if stream:
+                res = replay_stream(res)
+            return hash_object, res
+
+    # Only ever set from BACKGROUND_LOOP, so the session is always bound to the loop using it
+    client = get_async_client()
+    if litellm.aclient_session is not client:
+        litellm.aclient_session = client
+
+    tokens = rate_limit_tokens(model_name, messages, tokens)
+    if tokens is not None:
+        await RATE_LIMITER.acquire_async(model_name, tokens)
+
+    res = await litellm.acompletion(**kwargs)
+
+    if tokens is not None and not stream:
+        settle_rate_limit(model_name, tokens, res)
+
+    if CACHE is not None:
+        if stream:
+            res = CACHE.record_stream_async(hash_object.hexdigest(), res)
+        else:
+            CACHE.store(hash_object.hexdigest(), res)
 
     return hash_object, res
 
-@lazy_litellm_retry_decorator
+
+@with_retries
 def simple_send_with_retries(model_name, messages, extra_headers=None):
     try:
         kwargs = {
@@ -106,3 +276,21 @@ def simple_send_with_retries(model_name, messages, extra_headers=None):
         return response.choices[0].message.content
     except (AttributeError, litellm.exceptions.BadRequestError):
         return
+
+
+@with_retries
+async def async_simple_send_with_retries(model_name, messages, extra_headers=None):
+    try:
+        kwargs = {
+            "model_name": model_name,
+            "messages": messages,
+            "functions": None,
+            "stream": False,
+        }
+        if extra_headers is not None:
+            kwargs["extra_headers"] = extra_headers
+
+        _hash, response = await async_send_completion(**kwargs)
+        return response.choices[0].message.content
+    except (AttributeError, litellm.exceptions.BadRequestError):
+        return
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+from papertlab.dump import dump  # noqa: F401
+
+Tag = namedtuple("Tag", "rel_fname fname line name kind".split())
+
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS tags (
+    blob_id INTEGER NOT NULL REFERENCES blobs(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    line INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    blob_id INTEGER NOT NULL REFERENCES blobs(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS tags_blob_id ON tags(blob_id);
+CREATE INDEX IF NOT EXISTS tags_name ON tags(name);
+CREATE INDEX IF NOT EXISTS tags_kind ON tags(kind);
+CREATE INDEX IF NOT EXISTS files_blob_id ON files(blob_id);
+"""
+
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+MAX_QUERY_PARAMS = 500
+
+
+def content_hash(data, lang=None):
+    """A SHA1 of the given bytes and the language they're parsed as.
+
+    The same bytes give different tags in, say, a .py and a .txt file, so both go in.
+    """
+    header = f"{lang or ''}\0blob {len(data)}\0".encode()
+    return hashlib.sha1(header + data).hexdigest()
+
+
+def chunked(items, size=MAX_QUERY_PARAMS):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class TagStore:
+    """Relational index of the tags extracted from each file's contents.
+
+    Tags are stored one row each against the content hash they were extracted from,
+    which covers the file's bytes and language, so identical contents are only ever
+    parsed once, whichever path or checkout they come from. The files table remembers the
+    mtime and size each path had when it was last hashed, as a fast pre-filter that
+    avoids reading unchanged files.
+    Paths which no longer exist are forgotten when the store is opened, and contents
+    which no path has any longer are pruned along with their tags.
+
+    The store may live in a directory shared by several clones, worktrees or CI runners,
+    so its length only counts the files under root, the checkout using it.
+    """
+
+    DB_NAME = f"tags.v{SCHEMA_VERSION}.db"
+
+    def __init__(self, path=None, root=None):
+        self.lock = threading.RLock()
+        self.root = root
+
+        if path is None:
+            db_path = ":memory:"
+        else:
+            Path(path).mkdir(parents=True, exist_ok=True)
+            db_path = str(Path(path) / self.DB_NAME)
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        if path is not None:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        self.prune_files()
+        self.prune_blobs()
+
+    def __len__(self):
+        with self.lock:
+            if self.root is None:
+                return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+            # The paths under root, as a range scan of the primary key
+            prefix = os.path.join(self.root, "")
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM files WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)),
+            ).fetchone()[0]
+
+    def prune_files(self):
+        """Forget the paths which no longer exist, in any checkout sharing the store."""
+        with self.lock:
+            paths = [path for (path,) in self.conn.execute("SELECT path FROM files")]
+        missing = [path for path in paths if not os.path.exists(path)]
+        if not missing:
+            return
+
+        with self.lock, self.conn:
+            for chunk in chunked(missing):
+                marks = ",".join("?" * len(chunk))
+                self.conn.execute(f"DELETE FROM files WHERE path IN ({marks})", chunk)
+
+    def get_file_hashes(self, fnames):
+        """Map each of fnames which is in the store to its (mtime, size, hash)."""
+        res = dict()
+        with self.lock:
+            for chunk in chunked(list(fnames)):
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    "SELECT files.path, files.mtime, files.size, blobs.hash FROM files"
+                    f" JOIN blobs ON blobs.id = files.blob_id WHERE files.path IN ({marks})",
+                    chunk,
+                )
+                for fname, mtime, size, file_hash in rows:
+                    res[fname] = (mtime, size, file_hash)
+        return res
+
+    def get_tags_many(self, files):
+        """Load the stored tags of many files.
+
+        files maps each absolute fname to a (rel_fname, hash) pair.
+        Returns a dict of fname to a list of Tags, for the files whose hash is stored.
+        """
+        by_hash = defaultdict(list)
+        for fname, (rel_fname, file_hash) in files.items():
+            by_hash[file_hash].append((fname, rel_fname))
+
+        res = dict()
+        with self.lock:
+            for chunk in chunked(list(by_hash)):
+                marks = ",".join("?" * len(chunk))
+                rows = self.conn.execute(f"SELECT hash FROM blobs WHERE hash IN ({marks})", chunk)
+                for (file_hash,) in rows:
+                    for fname, _rel_fname in by_hash[file_hash]:
+                        res[fname] = []
+
+                rows = self.conn.execute(
+                    "SELECT blobs.hash, tags.name, tags.kind, tags.line FROM tags"
+                    " JOIN blobs ON blobs.id = tags.blob_id"
+                    f" WHERE blobs.hash IN ({marks}) ORDER BY tags.rowid",
+                    chunk,
+                )
+                for file_hash, name, kind, line in rows:
+                    for fname, rel_fname in by_hash[file_hash]:
+                        res[fname].append(
+                            Tag(
+                                rel_fname=rel_fname,
+                                fname=fname,
+                                name=name,
+                                kind=kind,
+                                line=line,
+                            )
+                        )
+        return res
+
+    def get_blob_ids(self, fnames):
+        blob_ids = set()
+        for chunk in chunked(list(fnames)):
+            marks = ",".join("?" * len(chunk))
+            rows = self.conn.execute(f"SELECT blob_id FROM files WHERE path IN ({marks})", chunk)
+            blob_ids.update(blob_id for (blob_id,) in rows)
+        return blob_ids
+
+    def prune_blobs(self, blob_ids=None):
+        """Delete the blobs which no file refers to, with their tags.
+
+        Only blob_ids are checked if given, otherwise the whole store.
+        """
+        unreferenced = "NOT EXISTS (SELECT 1 FROM files WHERE files.blob_id = blobs.id)"
+        with self.lock, self.conn:
+            if blob_ids is None:
+                self.conn.execute(f"DELETE FROM blobs WHERE {unreferenced}")
+                return
+
+            for chunk in chunked(list(blob_ids)):
+                marks = ",".join("?" * len(chunk))
+                self.conn.execute(
+                    f"DELETE FROM blobs WHERE id IN ({marks}) AND {unreferenced}", chunk
+                )
+
+    def set_files_many(self, entries):
+        """Record the (fname, mtime, size, hash) of files whose hash is already stored."""
+        entries = list(entries)
+        with self.lock, self.conn:
+            replaced = self.get_blob_ids(entry[0] for entry in entries)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, mtime, size, blob_id)"
+                " SELECT ?, ?, ?, id FROM blobs WHERE hash = ?",
+                entries,
+            )
+        self.prune_blobs(replaced)
+
+    def set_tags_many(self, entries):
+        """Store freshly extracted tags, in a single transaction.
+
+        entries is an iterable of (fname, mtime, size, hash, tags).
+        """
+        entries = list(entries)
+        with self.lock, self.conn:
+            replaced = self.get_blob_ids(entry[0] for entry in entries)
+            for fname, mtime, size, file_hash, tags in entries:
+                # Atomic, even if another process is storing the same contents
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO blobs (hash) VALUES (?)", (file_hash,)
+                )
+                is_new = cursor.rowcount == 1
+                blob_id = self.conn.execute(
+                    "SELECT id FROM blobs WHERE hash = ?", (file_hash,)
+                ).fetchone()[0]
+
+                if is_new:
+                    self.conn.executemany(
+                        "INSERT INTO tags (blob_id, name, kind, line) VALUES (?, ?, ?, ?)",
+                        ((blob_id, tag.name, tag.kind, tag.line) for tag in tags),
+                    )
+
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime, size, blob_id) VALUES (?, ?, ?, ?)",
+                    (fname, mtime, size, blob_id),
+                )
+        self.prune_blobs(replaced)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
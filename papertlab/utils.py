@@ -244,13 +244,17 @@ def run_install(cmd):
 class Spinner:
     spinner_chars = itertools.cycle(["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"])
 
-    def __init__(self, text):
+    def __init__(self, text, quiet=False):
         self.text = text
+        self.quiet = quiet
         self.start_time = time.time()
         self.last_update = 0
         self.visible = False
 
     def step(self):
+        if self.quiet:
+            return
+
         current_time = time.time()
         if not self.visible and current_time - self.start_time >= 0.5:
             self.visible = True
@@ -0,0 +1,205 @@
+import os
+import queue
+import threading
+import time
+import weakref
+
+from papertlab.dump import dump  # noqa: F401
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class RepoMapWatcher:
+    """Keep a RepoMap's tags and symbol graph current in a background thread.
+
+    Changes to the files in the map are noticed with watchdog if it is installed, or by
+    polling their mtimes otherwise. Changed files go into a bounded queue, and a worker
+    waits for the changes to settle for `debounce` seconds before refreshing the map.
+    If the queue overflows, as it will during a big branch switch, every file in the map
+    is refreshed once instead.
+    """
+
+    def __init__(
+        self,
+        repo_map,
+        io=None,
+        debounce=0.5,
+        poll_interval=1.0,
+        max_queue=1000,
+        use_watchdog=True,
+        verbose=False,
+    ):
+        # Don't keep a discarded RepoMap alive, the worker exits once it is collected
+        self.repo_map = weakref.ref(repo_map)
+        self.root = repo_map.root
+        self.io = io
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.overflow = threading.Event()
+        self.stopped = threading.Event()
+
+        self.watched_list = None
+        self.watched_set = set()
+
+        self.use_watchdog = use_watchdog and Observer is not None
+        self.observer = None
+        self.threads = []
+
+        # Release the observer's threads and inotify watches along with the RepoMap
+        weakref.finalize(repo_map, self.stop)
+
+    def start(self):
+        if self.use_watchdog:
+            try:
+                self.observer = Observer()
+                self.observer.schedule(WatchdogHandler(self), self.root, recursive=True)
+                self.observer.daemon = True
+                self.observer.start()
+            except OSError as err:
+                # eg: out of inotify watches
+                if self.verbose and self.io:
+                    self.io.tool_error(f"Unable to watch {self.root}, polling instead: {err}")
+                self.observer = None
+
+        if not self.observer:
+            self.start_thread(self.poll_worker)
+
+        self.start_thread(self.refresh_worker)
+
+    def start_thread(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            # Wake the refresh worker
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+        # The finalizer may run on one of our own threads, which can't join themselves
+        current = threading.current_thread()
+
+        observer, self.observer = self.observer, None
+        if observer:
+            observer.stop()
+            if observer is not current:
+                observer.join()
+
+        threads, self.threads = self.threads, []
+        for thread in threads:
+            if thread is not current:
+                thread.join()
+
+    def get_watched_fnames(self):
+        repo_map = self.repo_map()
+        if repo_map is None:
+            return []
+        return repo_map.watched_fnames
+
+    def get_watched_set(self):
+        # RepoMap replaces its list each time it builds a map
+        fnames = self.get_watched_fnames()
+        if fnames is not self.watched_list:
+            self.watched_list = fnames
+            self.watched_set = set(fnames)
+        return self.watched_set
+
+    def refresh_all(self):
+        """Have the worker refresh every file in the map."""
+        self.overflow.set()
+
+    def notify(self, fname):
+        """Queue a changed file, ignoring anything that isn't part of the map."""
+        if self.overflow.is_set() or fname not in self.get_watched_set():
+            return
+        try:
+            self.queue.put_nowait(fname)
+        except queue.Full:
+            self.overflow.set()
+
+    def poll_worker(self):
+        mtimes = dict()
+        while not self.stopped.wait(self.poll_interval):
+            for fname in self.get_watched_fnames():
+                try:
+                    file_mtime = os.path.getmtime(fname)
+                except OSError:
+                    continue
+
+                last_mtime = mtimes.get(fname)
+                mtimes[fname] = file_mtime
+                if last_mtime is not None and last_mtime != file_mtime:
+                    self.notify(fname)
+
+    def refresh_worker(self):
+        while not self.stopped.is_set():
+            try:
+                fnames = {self.queue.get(timeout=self.poll_interval)}
+            except queue.Empty:
+                if not self.overflow.is_set():
+                    continue
+                fnames = set()
+
+            # Wait for a burst of changes to settle before refreshing
+            while not self.stopped.is_set():
+                try:
+                    fnames.add(self.queue.get(timeout=self.debounce))
+                except queue.Empty:
+                    break
+
+            # stop() wakes the worker by queueing None
+            if self.stopped.is_set():
+                break
+
+            if self.overflow.is_set():
+                self.overflow.clear()
+                fnames = set(self.get_watched_fnames())
+
+            self.refresh(fnames)
+
+    def refresh(self, fnames):
+        repo_map = self.repo_map()
+        if repo_map is None:
+            self.stopped.set()
+            return
+
+        if not fnames:
+            return
+
+        start = time.time()
+        try:
+            num_changed = repo_map.refresh_files(fnames)
+        except Exception as err:
+            if self.verbose and self.io:
+                self.io.tool_error(f"Repo map watcher failed to refresh: {err}")
+            return
+
+        if self.verbose and self.io and num_changed:
+            self.io.tool_output(
+                f"Repo map watcher refreshed {num_changed} files in {time.time() - start:.2f}s"
+            )
+
+
+class WatchdogHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+
+        for path in (event.src_path, getattr(event, "dest_path", None)):
+            if path:
+                self.watcher.notify(os.path.abspath(os.fsdecode(path)))